@@ -1,111 +1,631 @@
+import json
+import asyncio
+import hashlib
 from fastapi import APIRouter, HTTPException, Path
+from fastapi.responses import StreamingResponse
 from datetime import datetime
-from typing import Dict, Any, List
-from app.db.models import db, GenerateRequest, GenerateResponse, RefineRequest, RefineResponse
-from app.utils.templateParser import fill_template
-from app.core.ai import embed_text, similarity_search, generate_text, construct_generation_prompt, construct_refinement_prompt
+from typing import Dict, Any, List, AsyncIterator, Tuple, Optional
+from app.db.models import (
+    Template, GeneratedDocument, RefinementTurn, GenerateRequest, GenerateResponse, RefineRequest, RefineResponse,
+    BatchGenerateRequest, BatchGenerateItem, BatchGenerateResponse
+)
+from app.db.repository import db
+from app.utils.templateParser import get_compiled_template
+from app.utils.retrieval import join_consecutive_chunks
+from app.core.config import settings
+from app.core.cache import generation_cache, chunk_cache, generation_flight
+from app.core.database import get_chunks
+from app.core.metrics import timed
+from app.core.ai import embed_text, embed_documents, EmbeddingError, similarity_search, generate_text, generate_chat, stream_chat, chat_messages, construct_generation_prompt, construct_refinement_messages, compact_refinement_turns, GENERATION_ERROR_MESSAGE
 
 router = APIRouter()
 
-@router.post("/generate", response_model=GenerateResponse)
-async def generate_document(request: GenerateRequest):
+GENERATION_SYSTEM_MESSAGE = "You are an assistant helping to create documents that comply with company policy."
+REFINEMENT_SYSTEM_MESSAGE = "You are an assistant helping to refine documents to comply with company policy."
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
     """
-    Generate a document based on a template and user inputs
+    Format a server-sent event
+    
+    Args:
+        event: The event name
+        data: JSON-serializable event data
+    
+    Returns:
+        The encoded event
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def resolve_template(template_id: str) -> Tuple[Template, List[str]]:
+    """
+    Look up a template and the content hashes of its policies
+    
+    Args:
+        template_id: ID of the template
+    
+    Returns:
+        Tuple of (template, content hashes of its policies)
     """
     # Validate template exists
-    if request.template_id not in db.templates:
+    template = await db.get_template(template_id)
+    if template is None:
         raise HTTPException(status_code=404, detail="Template not found")
     
-    template = db.templates[request.template_id]
+    # Get the content hashes of the associated policies
+    policy_hashes = [policy.content_hash for policy in await db.get_policies(template.associated_policies)]
+    
+    return template, policy_hashes
+
+async def resolve_generation(request: GenerateRequest) -> Tuple[Template, str, List[str]]:
+    """
+    Look up the template of a generation request and fill it
+    
+    Args:
+        request: The generation request
+    
+    Returns:
+        Tuple of (template, filled template, content hashes of its policies)
+    """
+    template, policy_hashes = await resolve_template(request.template_id)
     
     # Fill template with user inputs
-    filled_template = fill_template(template.content, request.inputs)
+    with timed("fill_template"):
+        filled_template = get_compiled_template(template).fill(request.inputs)
     
-    # Get associated policies
-    policy_ids = template.associated_policies
+    return template, filled_template, policy_hashes
+
+def generation_cache_key(template: Template, inputs: Dict[str, str], policy_hashes: List[str]) -> str:
+    """
+    Build the result cache key of a generation request
     
-    # Generate embedding for the filled template
-    query_vector = await embed_text(filled_template)
+    Inputs are normalized by dropping values for fields the template does
+    not have and trimming surrounding whitespace.
     
-    # Retrieve relevant policy chunks
-    policy_chunks = await similarity_search(query_vector, policy_ids)
+    Args:
+        template: The template
+        inputs: The user inputs
+        policy_hashes: Content hashes of the template's policies
     
-    # Construct prompt for the LLM
-    prompt = await construct_generation_prompt(filled_template, policy_chunks)
+    Returns:
+        The cache key
+    """
+    field_ids = {field.id for field in template.input_fields}
+    normalized_inputs = {key: value.strip() for key, value in inputs.items() if key in field_ids}
     
-    # Generate content using the LLM
-    system_message = "You are an assistant helping to create documents that comply with company policy."
-    content = await generate_text(prompt, system_message)
+    key = json.dumps([
+        template.id,
+        template.updated_at.isoformat(),
+        normalized_inputs,
+        sorted(set(policy_hashes)),
+        settings.ai.generation_model,
+    ], sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def generation_cache_tags(template_id: str, policy_hashes: List[str]) -> List[str]:
+    """Get the tags a cached generation is invalidated by"""
+    return [f"template:{template_id}"] + [f"policy:{policy_hash}" for policy_hash in policy_hashes]
+
+def chunk_parts(policy_chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Get the stored chunks that retrieved (possibly merged) chunks were built from"""
+    return [part for chunk in policy_chunks for part in chunk.get("parts", [chunk])]
+
+def intern_chunks(policy_chunks: List[Dict[str, Any]]):
+    """
+    Cache retrieved chunk texts so refinements can resolve them by ID
     
-    # Create document record
-    document_id = db.generate_id()
-    now = datetime.now()
+    Scores are left out: they belong to the query that found the chunk.
+    """
+    for chunk in chunk_parts(policy_chunks):
+        chunk_cache.put(chunk["id"], {key: value for key, value in chunk.items() if key not in ("parts", "score")})
+
+async def load_chunks(chunk_ids: List[str]) -> List[Dict[str, Any]]:
+    """
+    Get policy chunks by ID, fetching the ones not in the chunk cache
+    
+    Args:
+        chunk_ids: Point IDs of the chunks
+    
+    Returns:
+        The chunks that could be found, in the requested order
+    """
+    chunks = {}
+    missing = []
+    for chunk_id in chunk_ids:
+        chunk = chunk_cache.get(chunk_id)
+        if chunk is None:
+            missing.append(chunk_id)
+        else:
+            chunks[chunk_id] = chunk
+    
+    if missing:
+        try:
+            fetched = await get_chunks(missing)
+            intern_chunks(fetched)
+            chunks.update((chunk["id"], chunk) for chunk in fetched)
+        except Exception as e:
+            print(f"Error fetching policy chunks: {e}")
+    
+    return [chunks[chunk_id] for chunk_id in chunk_ids if chunk_id in chunks]
+
+async def prepare_generation(
+    template_id: str,
+    filled_template: str,
+    policy_hashes: List[str],
+    query_vector: Optional[List[float]] = None
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Build the generation prompt and refinement context for a filled template
+    
+    Args:
+        template_id: ID of the template used
+        filled_template: The template filled with user inputs
+        policy_hashes: Content hashes of the policies to search
+        query_vector: Embedding of the filled template, if already computed
+    
+    Returns:
+        Tuple of (prompt, context stored with the generated document)
+    """
+    # Generate embedding for the filled template; without it the policy
+    # search would be meaningless, so the request fails instead
+    if query_vector is None:
+        try:
+            with timed("embed_text"):
+                query_vector = await embed_text(filled_template)
+        except EmbeddingError as e:
+            print(f"Error embedding generation request: {e}")
+            raise HTTPException(status_code=502, detail="Unable to process the request inputs. Please try again.")
     
-    # Store context for potential refinement
+    # Retrieve relevant policy chunks
+    with timed("similarity_search"):
+        policy_chunks = await similarity_search(query_vector, policy_hashes)
+    
+    # Construct prompt for the LLM
+    with timed("construct_prompt"):
+        prompt = await construct_generation_prompt(filled_template, policy_chunks, GENERATION_SYSTEM_MESSAGE)
+    
+    # Store context for potential refinement, referencing the chunks by ID
+    intern_chunks(policy_chunks)
     context = {
-        "template_id": request.template_id,
+        "template_id": template_id,
         "filled_template": filled_template,
-        "policy_sections": "\n\n".join([f"From {chunk['policy_name']}:\n{chunk['text']}" for chunk in policy_chunks])
+        "chunk_ids": [chunk["id"] for chunk in chunk_parts(policy_chunks)]
     }
     
-    db.generated_documents[document_id] = {
-        "id": document_id,
-        "content": content,
-        "generated_at": now,
-        "template_id": request.template_id,
-        "context": context
-    }
+    return prompt, context
+
+async def store_generated_document(template_id: str, content: str, context: Dict[str, Any]) -> GenerateResponse:
+    """
+    Store a newly generated document
+    
+    Args:
+        template_id: ID of the template used
+        content: The generated content
+        context: Request context for potential refinement
+    
+    Returns:
+        The stored document
+    """
+    document_id = db.generate_id()
+    now = datetime.now()
+    
+    await db.save_document(GeneratedDocument(
+        id=document_id,
+        content=content,
+        generated_at=now,
+        template_id=template_id,
+        context=context
+    ))
     
     return GenerateResponse(
         id=document_id,
         content=content,
         generated_at=now,
-        template_id=request.template_id
+        template_id=template_id
     )
 
-@router.post("/refine/{document_id}", response_model=RefineResponse)
-async def refine_document(
-    request: RefineRequest,
-    document_id: str = Path(..., description="The ID of the document to refine")
-):
+def cache_generation(cache_key: str, cache_tags: List[str], content: str, context: Dict[str, Any]):
     """
-    Refine a generated document based on user feedback
+    Cache the result of a generation unless it failed or is empty
+    
+    Args:
+        cache_key: Result cache key of the request
+        cache_tags: Tags the cached result is invalidated by
+        content: The generated content
+        context: Request context for potential refinement
+    """
+    if content.strip() and content != GENERATION_ERROR_MESSAGE:
+        generation_cache.put(cache_key, (content, context), cache_tags)
+
+async def finish_generation(template_id: str, content: str, context: Dict[str, Any], cache_key: str, cache_tags: List[str]) -> GenerateResponse:
+    """
+    Cache a successful generation and store it as a new document
+    
+    Args:
+        template_id: ID of the template used
+        content: The generated content
+        context: Request context for potential refinement
+        cache_key: Result cache key of the request
+        cache_tags: Tags the cached result is invalidated by
+    
+    Returns:
+        The stored document
+    """
+    cache_generation(cache_key, cache_tags, content, context)
+    return await store_generated_document(template_id, content, context)
+
+async def generate_content(
+    template_id: str,
+    filled_template: str,
+    policy_hashes: List[str],
+    cache_key: str,
+    cache_tags: List[str],
+    query_vector: Optional[List[float]] = None,
+    use_cache: bool = True
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Run the generation pipeline for a request and cache a successful result
+    
+    Args:
+        template_id: ID of the template used
+        filled_template: The template filled with user inputs
+        policy_hashes: Content hashes of the policies to search
+        cache_key: Result cache key of the request
+        cache_tags: Tags the cached result is invalidated by
+        query_vector: Embedding of the filled template, if already computed
+        use_cache: Whether the request accepts a shared result; if not, the
+            completion is not coalesced with identical requests in flight
+    
+    Returns:
+        Tuple of (generated content, context for potential refinement)
+    """
+    prompt, context = await prepare_generation(template_id, filled_template, policy_hashes, query_vector)
+    
+    # Generate content using the LLM
+    content = await generate_text(prompt, GENERATION_SYSTEM_MESSAGE, coalesce=use_cache)
+    
+    cache_generation(cache_key, cache_tags, content, context)
+    return content, context
+
+async def prepare_refinement(document_id: str, request: RefineRequest) -> Tuple[GeneratedDocument, List[Dict[str, str]]]:
+    """
+    Build the chat messages for the next turn of a document's refinement session
+    
+    Args:
+        document_id: ID of the document to refine
+        request: The refinement request
+    
+    Returns:
+        Tuple of (stored document with its history compacted, chat messages)
     """
     # Validate document exists
-    if document_id not in db.generated_documents:
+    document = await db.get_document(document_id)
+    if document is None:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    document = db.generated_documents[document_id]
+    # Resolve the policy sections the document was generated from. They are
+    # kept in the stored order, which is the ranked order of the generation,
+    # so the prompt prefix is identical on every turn; merged chunks were
+    # stored as consecutive parts and are rejoined the same way.
+    context = dict(document.context)
+    with timed("load_chunks"):
+        chunks = await load_chunks(context.pop("chunk_ids", []))
+    if settings.rag.merge_adjacent:
+        chunks = join_consecutive_chunks(chunks, 2 * settings.rag.chunk_overlap)
+    if chunks:
+        context["policy_sections"] = "\n\n".join([f"From {chunk['policy_name']}:\n{chunk['text']}" for chunk in chunks])
     
-    # Construct refinement prompt
-    prompt = await construct_refinement_prompt(
-        document["content"],
-        request.feedback,
-        document["context"]
-    )
+    # Compact older turns before they outgrow the history budget
+    document = document.model_copy(update={
+        "original_content": document.original_content or document.content,
+        "turns": compact_refinement_turns(document.turns)
+    })
     
-    # Generate refined content
-    system_message = "You are an assistant helping to refine documents to comply with company policy."
-    refined_content = await generate_text(prompt, system_message)
+    # Construct refinement messages
+    with timed("construct_prompt"):
+        messages = await construct_refinement_messages(
+            document.original_content,
+            document.turns,
+            request.feedback,
+            context,
+            REFINEMENT_SYSTEM_MESSAGE
+        )
+    
+    return document, messages
+
+async def store_refined_document(document: GeneratedDocument, feedback: str, refined_content: str) -> RefineResponse:
+    """
+    Record a refinement turn and make its content the document's current content
+    
+    Args:
+        document: The stored document, as returned by prepare_refinement
+        feedback: The feedback the document was refined with
+        refined_content: The refined content
     
-    # Update document
+    Returns:
+        The updated document
+    """
     now = datetime.now()
+    revision = document.revision + 1
     
-    updated_document = {
-        "id": document_id,
+    updated_document = document.model_copy(update={
         "content": refined_content,
-        "generated_at": document["generated_at"],
         "refined_at": now,
-        "template_id": document["template_id"],
-        "context": document["context"]
-    }
-    
-    db.generated_documents[document_id] = updated_document
+        "turns": document.turns + [RefinementTurn(feedback=feedback, content=refined_content, refined_at=now)],
+        "revision": revision
+    })
+    await db.save_document(updated_document)
     
     return RefineResponse(
-        id=document_id,
+        id=document.id,
         content=refined_content,
-        generated_at=document["generated_at"],
+        generated_at=document.generated_at,
         refined_at=now,
-        template_id=document["template_id"]
-    ) 
\ No newline at end of file
+        template_id=document.template_id,
+        revision=revision
+    )
+
+async def cached_events(content: str, store) -> AsyncIterator[str]:
+    """
+    Send a cached result as a single "token" event followed by "done"
+    
+    Args:
+        content: The cached content
+        store: Coroutine function that stores the content and returns the response model
+    """
+    yield sse_event("token", {"text": content})
+    response = await store(content)
+    yield sse_event("done", response.model_dump(mode="json", exclude={"content"}))
+
+async def stream_events(messages: List[Dict[str, str]], store) -> AsyncIterator[str]:
+    """
+    Stream generated tokens as server-sent events and store the result
+    
+    Emits a "token" event for each piece of text, then a "done" event with
+    the stored document (without its content), or an "error" event. Only a
+    completed, non-empty stream is stored.
+    
+    Args:
+        messages: The chat messages to generate from
+        store: Coroutine function that stores the complete content and returns the response model
+    """
+    pieces: List[str] = []
+    try:
+        async for piece in stream_chat(messages):
+            pieces.append(piece)
+            yield sse_event("token", {"text": piece})
+    except Exception as e:
+        print(f"Error streaming generated text: {e}")
+        yield sse_event("error", {"detail": "Unable to generate text. Please try again."})
+        return
+    
+    content = "".join(pieces)
+    if not content.strip():
+        yield sse_event("error", {"detail": "Unable to generate text. Please try again."})
+        return
+    
+    response = await store(content)
+    yield sse_event("done", response.model_dump(mode="json", exclude={"content"}))
+
+@router.post("/generate", response_model=GenerateResponse)
+async def generate_document(request: GenerateRequest):
+    """
+    Generate a document based on a template and user inputs
+    """
+    template, filled_template, policy_hashes = await resolve_generation(request)
+    cache_key = generation_cache_key(template, request.inputs, policy_hashes)
+    cache_tags = generation_cache_tags(template.id, policy_hashes)
+    
+    # Reuse the result of an identical earlier request
+    cached = generation_cache.get(cache_key) if request.use_cache else None
+    if cached is not None:
+        content, context = cached
+        return await store_generated_document(template.id, content, context)
+    
+    def generate():
+        return generate_content(
+            template.id, filled_template, policy_hashes, cache_key, cache_tags, use_cache=request.use_cache
+        )
+    
+    # Identical requests in flight at the same time share one generation
+    if request.use_cache:
+        content, context = await generation_flight.do(cache_key, generate)
+    else:
+        content, context = await generate()
+    
+    return await store_generated_document(template.id, content, context)
+
+@router.post("/generate/stream")
+async def generate_document_stream(request: GenerateRequest):
+    """
+    Generate a document, streaming tokens as server-sent events
+    """
+    template, filled_template, policy_hashes = await resolve_generation(request)
+    cache_key = generation_cache_key(template, request.inputs, policy_hashes)
+    cache_tags = generation_cache_tags(template.id, policy_hashes)
+    
+    cached = generation_cache.get(cache_key) if request.use_cache else None
+    if cached is not None:
+        content, context = cached
+        events = cached_events(
+            content,
+            lambda content: store_generated_document(template.id, content, context)
+        )
+    else:
+        prompt, context = await prepare_generation(template.id, filled_template, policy_hashes)
+        events = stream_events(
+            chat_messages(prompt, GENERATION_SYSTEM_MESSAGE),
+            lambda content: finish_generation(template.id, content, context, cache_key, cache_tags)
+        )
+    
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def run_batch(request: BatchGenerateRequest) -> AsyncIterator[BatchGenerateItem]:
+    """
+    Generate documents for many input sets against one template
+    
+    Identical fills are generated once, cached results are reused, and the
+    remaining queries are embedded in one batched call before the vector
+    searches and LLM calls run with bounded concurrency.
+    
+    Args:
+        request: The batch generation request
+    
+    Yields:
+        A result for each input set, in completion order
+    """
+    template, policy_hashes = await resolve_template(request.template_id)
+    compiled = get_compiled_template(template)
+    cache_tags = generation_cache_tags(template.id, policy_hashes)
+    
+    # Group input sets that produce the same request
+    groups: Dict[str, List[int]] = {}
+    filled_templates: Dict[str, str] = {}
+    for index, inputs in enumerate(request.inputs):
+        cache_key = generation_cache_key(template, inputs, policy_hashes)
+        groups.setdefault(cache_key, []).append(index)
+        filled_templates.setdefault(cache_key, compiled.fill(inputs))
+    
+    async def results_for(cache_key: str, content: str, context: Dict[str, Any]) -> List[BatchGenerateItem]:
+        return [
+            BatchGenerateItem(index=index, document=await store_generated_document(template.id, content, context))
+            for index in groups[cache_key]
+        ]
+    
+    # Reuse cached results
+    pending = []
+    for cache_key in groups:
+        cached = generation_cache.get(cache_key) if request.use_cache else None
+        if cached is not None:
+            for item in await results_for(cache_key, *cached):
+                yield item
+        else:
+            pending.append(cache_key)
+    
+    if not pending:
+        return
+    
+    # Embed all remaining queries together
+    try:
+        query_vectors = await embed_documents([filled_templates[cache_key] for cache_key in pending])
+    except Exception as e:
+        print(f"Error embedding batch generation queries: {e}")
+        for cache_key in pending:
+            for index in groups[cache_key]:
+                yield BatchGenerateItem(index=index, error="Unable to process the request inputs")
+        return
+    
+    semaphore = asyncio.Semaphore(settings.ai.generation_batch_concurrency)
+    
+    async def generate(cache_key: str, query_vector: List[float]) -> List[BatchGenerateItem]:
+        def call():
+            return generate_content(
+                template.id, filled_templates[cache_key], policy_hashes, cache_key, cache_tags, query_vector,
+                request.use_cache
+            )
+        
+        try:
+            async with semaphore:
+                if request.use_cache:
+                    content, context = await generation_flight.do(cache_key, call)
+                else:
+                    content, context = await call()
+            return await results_for(cache_key, content, context)
+        except Exception as e:
+            print(f"Error generating batch item: {e}")
+            return [BatchGenerateItem(index=index, error="Unable to generate the document") for index in groups[cache_key]]
+    
+    tasks = [
+        asyncio.create_task(generate(cache_key, query_vector))
+        for cache_key, query_vector in zip(pending, query_vectors)
+    ]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            for item in await finished:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def validate_batch(request: BatchGenerateRequest):
+    """Reject empty or oversized batches"""
+    if not request.inputs:
+        raise HTTPException(status_code=400, detail="At least one set of inputs is required")
+    if len(request.inputs) > settings.ai.generation_batch_max_items:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch can contain at most {settings.ai.generation_batch_max_items} sets of inputs"
+        )
+
+@router.post("/generate/batch", response_model=BatchGenerateResponse)
+async def generate_batch(request: BatchGenerateRequest):
+    """
+    Generate documents for many sets of inputs against one template
+    """
+    validate_batch(request)
+    
+    results = [item async for item in run_batch(request)]
+    results.sort(key=lambda item: item.index)
+    
+    return BatchGenerateResponse(results=results)
+
+@router.post("/generate/batch/stream")
+async def generate_batch_stream(request: BatchGenerateRequest):
+    """
+    Generate documents for many sets of inputs, streaming each result as a server-sent event
+    """
+    validate_batch(request)
+    # Look up the template before the response starts so a missing one is a 404
+    await resolve_template(request.template_id)
+    
+    async def events() -> AsyncIterator[str]:
+        async for item in run_batch(request):
+            yield sse_event("result", item.model_dump(mode="json"))
+        yield sse_event("done", {"count": len(request.inputs)})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/refine/{document_id}", response_model=RefineResponse)
+async def refine_document(
+    request: RefineRequest,
+    document_id: str = Path(..., description="The ID of the document to refine")
+):
+    """
+    Refine a generated document based on user feedback
+    """
+    document, messages = await prepare_refinement(document_id, request)
+    
+    # Generate refined content
+    refined_content = await generate_chat(messages)
+    
+    # Keep the document and its session unchanged rather than recording the error as a revision
+    if refined_content == GENERATION_ERROR_MESSAGE:
+        raise HTTPException(status_code=502, detail="Unable to refine the document. Please try again.")
+    
+    return await store_refined_document(document, request.feedback, refined_content)
+
+@router.post("/refine/{document_id}/stream")
+async def refine_document_stream(
+    request: RefineRequest,
+    document_id: str = Path(..., description="The ID of the document to refine")
+):
+    """
+    Refine a generated document, streaming tokens as server-sent events
+    """
+    document, messages = await prepare_refinement(document_id, request)
+    
+    return StreamingResponse(
+        stream_events(
+            messages,
+            lambda content: store_refined_document(document, request.feedback, content)
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,101 +1,182 @@
 import os
-import uuid
-import shutil
+import hashlib
 from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Path
-from typing import Optional
 from datetime import datetime
-from app.db.models import db, Policy, PolicyCreate
-from app.core.config import settings
-from app.utils.pdf import process_pdf
-from app.core.ai import embed_documents
-from app.core.database import store_embeddings, delete_document, get_document_by_hash
+from typing import Optional
+from app.db.models import IngestionJob
+from app.db.repository import db
+from app.core.ingestion import submit_job, cancel_job, upload_path, release_document, policy_lock, QueueFullError
 
 router = APIRouter()
 
+# Size of the blocks read from an upload while it is hashed and saved
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
 @router.get("/policies", response_model=dict)
 async def get_policies():
     """
     Get all policy documents
     """
-    policies = list(db.policies.values())
+    policies = await db.list_policies()
     return {"policies": policies}
 
-@router.post("/policies", response_model=Policy)
-async def upload_policy(
-    file: UploadFile = File(...),
-    description: str = Form("")
-):
+async def save_upload(file: UploadFile, path: str) -> str:
     """
-    Upload a new policy document
+    Stream an upload to disk while hashing its contents
+    
+    Args:
+        file: The uploaded file
+        path: Path to save the file to
+    
+    Returns:
+        SHA-256 hex digest of the file
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, "wb") as buffer:
+            while True:
+                block = await file.read(UPLOAD_BLOCK_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+                buffer.write(block)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return digest.hexdigest()
+
+async def queue_upload(
+    file: UploadFile,
+    policy_id: str,
+    name: str,
+    description: str,
+    replaces: Optional[str] = None
+) -> IngestionJob:
+    """
+    Save an uploaded policy document and queue its ingestion job
+    
+    Args:
+        file: The uploaded PDF
+        policy_id: ID of the policy record the job creates or updates
+        name: Name of the policy
+        description: Description of the policy
+        replaces: Content hash of the version a policy update replaces
+    
+    Returns:
+        The queued job
     """
     # Validate file type
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are supported")
     
-    # Generate unique ID and file path
-    policy_id = db.generate_id()
-    file_name = f"{policy_id}_{file.filename}"
-    file_path = os.path.join(settings.upload_dir, file_name)
+    # Generate unique IDs and hash the file as it is saved
+    job_id = db.generate_id()
+    file_path = upload_path(job_id)
     
     try:
-        # Save the uploaded file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Process the PDF
-        chunks = await process_pdf(file_path)
-        
-        if not chunks:
-            raise HTTPException(status_code=400, detail="Failed to extract text from the PDF")
-        
-        # Generate embeddings
-        embeddings = await embed_documents(chunks)
-        
-        # Store in vector database
-        content_hash = await store_embeddings(policy_id, file.filename, file_path, chunks, embeddings)
-        
-        # Create policy record
-        now = datetime.now()
-        
-        policy = Policy(
-            id=policy_id,
-            name=file.filename,
-            description=description,
-            uploaded_at=now
-        )
-        
-        # Store in database
-        db.policies[policy_id] = policy
-        
-        return policy
+        content_hash = await save_upload(file, file_path)
     except Exception as e:
-        # Clean up on error
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        raise HTTPException(status_code=500, detail=f"Failed to process policy document: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to save policy document: {str(e)}")
+    
+    now = datetime.now()
+    job = IngestionJob(
+        id=job_id,
+        policy_id=policy_id,
+        name=name,
+        description=description,
+        content_hash=content_hash,
+        created_at=now,
+        updated_at=now,
+        replaces=replaces
+    )
+    
+    try:
+        await submit_job(job)
+    except QueueFullError as e:
+        os.remove(file_path)
+        raise HTTPException(status_code=503, detail=str(e))
+    
+    return job
 
-@router.delete("/policies/{policy_id}")
-async def delete_policy(policy_id: str = Path(..., description="The ID of the policy to delete")):
+@router.post("/policies", response_model=IngestionJob, status_code=202)
+async def upload_policy(
+    file: UploadFile = File(...),
+    description: str = Form("")
+):
     """
-    Delete a policy document
+    Upload a new policy document
+    
+    The document is processed in the background; poll the returned job for progress.
+    """
+    return await queue_upload(file, db.generate_id(), file.filename, description)
+
+@router.put("/policies/{policy_id}", response_model=IngestionJob, status_code=202)
+async def update_policy(
+    policy_id: str = Path(..., description="The ID of the policy to update"),
+    file: UploadFile = File(...),
+    name: Optional[str] = Form(None),
+    description: Optional[str] = Form(None)
+):
+    """
+    Upload a revised version of a policy document
+    
+    Only chunks that changed since the current version are embedded. The
+    policy, and the templates that use it, switch to the new version when
+    the returned job completes.
     """
-    if policy_id not in db.policies:
+    policy = await db.get_policy(policy_id)
+    if policy is None:
         raise HTTPException(status_code=404, detail="Policy document not found")
     
-    policy = db.policies[policy_id]
+    return await queue_upload(
+        file,
+        policy_id,
+        name if name is not None else policy.name,
+        description if description is not None else policy.description,
+        replaces=policy.content_hash
+    )
+
+@router.get("/policies/jobs/{job_id}", response_model=IngestionJob)
+async def get_policy_job(job_id: str = Path(..., description="The ID of the ingestion job")):
+    """
+    Get the status and progress of a policy ingestion job
+    """
+    job = await db.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingestion job not found")
     
-    # Get the file path
-    file_name = f"{policy_id}_{policy.name}"
-    file_path = os.path.join(settings.upload_dir, file_name)
+    return job
+
+@router.delete("/policies/jobs/{job_id}", response_model=IngestionJob)
+async def cancel_policy_job(job_id: str = Path(..., description="The ID of the ingestion job")):
+    """
+    Cancel a policy ingestion job and remove its partial results
+    """
+    job = await db.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingestion job not found")
     
-    # Delete from vector database
-    await delete_document(policy_id)
+    if not await cancel_job(job):
+        raise HTTPException(status_code=409, detail=f"Ingestion job already {job.status}")
     
-    # Delete the file if it exists
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    # A running job records its cancellation on its own copy of the job
+    return await db.get_job(job_id)
+
+@router.delete("/policies/{policy_id}")
+async def delete_policy(policy_id: str = Path(..., description="The ID of the policy to delete")):
+    """
+    Delete a policy document
+    """
+    # Hold the policy's lock so an update finishing now cannot save it again
+    async with policy_lock(policy_id):
+        policy = await db.get_policy(policy_id)
+        if policy is None:
+            raise HTTPException(status_code=404, detail="Policy document not found")
+        
+        await db.delete_policy(policy_id)
     
-    # Delete from database
-    del db.policies[policy_id]
+    # Delete the stored file and vectors unless other policies share the same contents
+    await release_document(policy.content_hash)
     
-    return {"message": "Policy document successfully deleted"} 
\ No newline at end of file
+    return {"message": "Policy document successfully deleted"}
@@ -1,8 +1,10 @@
 from typing import List
 from fastapi import APIRouter, HTTPException, Path
 from datetime import datetime
-from app.db.models import db, Template, TemplateCreate, TemplateUpdate, InputField
-from app.utils.templateParser import parse_template
+from app.db.models import Template, TemplateCreate, TemplateUpdate, InputField
+from app.db.repository import db
+from app.utils.templateParser import compile_template, cache_compiled_template, invalidate_compiled_template
+from app.core.cache import generation_cache
 
 router = APIRouter()
 
@@ -11,7 +13,7 @@ async def get_templates():
     """
     Get all templates
     """
-    templates = list(db.templates.values())
+    templates = await db.list_templates()
     return {"templates": templates}
 
 @router.get("/templates/{template_id}", response_model=Template)
@@ -19,10 +21,11 @@ async def get_template(template_id: str = Path(..., description="The ID of the t
     """
     Get a specific template by ID
     """
-    if template_id not in db.templates:
+    template = await db.get_template(template_id)
+    if template is None:
         raise HTTPException(status_code=404, detail="Template not found")
     
-    return db.templates[template_id]
+    return template
 
 @router.post("/templates", response_model=Template)
 async def create_template(template: TemplateCreate):
@@ -32,8 +35,8 @@ async def create_template(template: TemplateCreate):
     template_id = db.generate_id()
     now = datetime.now()
     
-    # Parse input fields from template content
-    input_fields = parse_template(template.content)
+    # Compile the template and take its input fields
+    compiled = compile_template(template.content)
     
     new_template = Template(
         id=template_id,
@@ -43,10 +46,11 @@ async def create_template(template: TemplateCreate):
         associated_policies=template.associated_policies,
         created_at=now,
         updated_at=now,
-        input_fields=input_fields
+        input_fields=compiled.input_fields
     )
     
-    db.templates[template_id] = new_template
+    await db.save_template(new_template)
+    cache_compiled_template(template_id, now, compiled)
     return new_template
 
 @router.put("/templates/{template_id}", response_model=Template)
@@ -57,13 +61,12 @@ async def update_template(
     """
     Update an existing template
     """
-    if template_id not in db.templates:
+    existing_template = await db.get_template(template_id)
+    if existing_template is None:
         raise HTTPException(status_code=404, detail="Template not found")
     
-    existing_template = db.templates[template_id]
-    
-    # Parse input fields from template content
-    input_fields = parse_template(template.content)
+    # Compile the template and take its input fields
+    compiled = compile_template(template.content)
     
     updated_template = Template(
         id=template_id,
@@ -73,10 +76,12 @@ async def update_template(
         associated_policies=template.associated_policies,
         created_at=existing_template.created_at,
         updated_at=datetime.now(),
-        input_fields=input_fields
+        input_fields=compiled.input_fields
     )
     
-    db.templates[template_id] = updated_template
+    await db.save_template(updated_template)
+    cache_compiled_template(template_id, updated_template.updated_at, compiled)
+    generation_cache.invalidate(f"template:{template_id}")
     return updated_template
 
 @router.delete("/templates/{template_id}")
@@ -84,8 +89,9 @@ async def delete_template(template_id: str = Path(..., description="The ID of th
     """
     Delete a template
     """
-    if template_id not in db.templates:
+    if not await db.delete_template(template_id):
         raise HTTPException(status_code=404, detail="Template not found")
     
-    del db.templates[template_id]
+    invalidate_compiled_template(template_id)
+    generation_cache.invalidate(f"template:{template_id}")
     return {"message": "Template successfully deleted"} 
\ No newline at end of file
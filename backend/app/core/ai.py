@@ -1,139 +1,799 @@
-from typing import List, Dict, Any
-import openai
+import json
+import time
+import asyncio
+from typing import List, Dict, Any, Optional, Callable, AsyncIterator, Tuple
+import httpx
 from app.core.config import settings
 from app.core.database import similarity_search
+from app.core.cache import embedding_cache, embedding_flight, completion_flight, text_hash
+from app.core.metrics import timed, record_tokens, llm_tokens, llm_requests_in_flight, llm_first_token_seconds
+from app.db.models import RefinementTurn
+from app.utils.tokens import count_tokens, truncate_tokens, get_context_window
+
+# Returned instead of generated text when the AI API call fails
+GENERATION_ERROR_MESSAGE = "Error: Unable to generate text. It appears the policy isn't clear on this matter. Please take appropriate action based on your judgment."
+
+
+GENERATION_PROMPT = """USER REQUEST:
+{filled_template}
+
+RELEVANT POLICY SECTIONS:
+{policy_text}
+
+Please generate a well-formatted, policy-compliant document based on the user's request.
+Ensure that all information complies with the provided policy sections.
+If the policy is unclear or missing relevant information, please indicate this in your response.
+"""
+
+# Refinement sessions: the request context the first draft answers, then
+# one feedback message per turn (or a summary of compacted turns)
+REFINEMENT_CONTEXT_PROMPT = """Original request:
+{filled_template}
+
+Relevant policy sections:
+{policy_sections}
+
+Please generate a well-formatted, policy-compliant document based on this request.
+"""
+
+REFINEMENT_FEEDBACK_PROMPT = """The user has provided the following feedback:
+{feedback}
+
+Please refine the document based on the user's feedback while ensuring it remains compliant with policy.
+"""
+
+REFINEMENT_SUMMARY_PROMPT = """The document was refined based on this earlier feedback:
+{feedback}
+"""
+
+# Tokens of chat formatting added around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Policy chunks are not trimmed below this many tokens; they are dropped instead
+MIN_CHUNK_TOKENS = 64
+
+# Feedback requests kept in the summary of compacted refinement turns (most recent first)
+MAX_SUMMARY_FEEDBACK = 10
+
+
+class EmbeddingError(Exception):
+    """Raised when embeddings cannot be generated for a batch of texts"""
+
+
+class GenerationError(Exception):
+    """Raised when a streamed completion ends without completing"""
+
+
+class PromptStats:
+    """Running totals of prompt tokens per section and of policy chunks that did not fit"""
+    
+    def __init__(self):
+        self.prompts: Dict[str, int] = {}
+        self.section_tokens: Dict[str, Dict[str, int]] = {}
+        self.chunks_dropped = 0
+        self.chunks_trimmed = 0
+    
+    def record(self, kind: str, sections: Dict[str, int], dropped: int = 0, trimmed: int = 0):
+        """
+        Add the token counts of a constructed prompt
+        
+        Args:
+            kind: The kind of prompt ("generation" or "refinement")
+            sections: Number of tokens in each section of the prompt
+            dropped: Policy chunks left out to fit the budget
+            trimmed: Policy chunks shortened to fit the budget
+        """
+        self.prompts[kind] = self.prompts.get(kind, 0) + 1
+        totals = self.section_tokens.setdefault(kind, {})
+        for name, tokens in sections.items():
+            totals[name] = totals.get(name, 0) + tokens
+        self.chunks_dropped += dropped
+        self.chunks_trimmed += trimmed
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get prompt counts, average tokens per section and chunk counters"""
+        return {
+            "context_window": context_window(),
+            **{
+                kind: {
+                    "prompts": count,
+                    "avg_section_tokens": {
+                        name: tokens / count for name, tokens in self.section_tokens[kind].items()
+                    },
+                }
+                for kind, count in self.prompts.items()
+            },
+            "chunks_dropped": self.chunks_dropped,
+            "chunks_trimmed": self.chunks_trimmed,
+        }
+
+
+prompt_stats = PromptStats()
+
+
+# Shared async HTTP client for the OpenAI-compatible API, created on first use
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Get the shared HTTP client for the AI API
+    
+    The client keeps a pool of keep-alive connections to settings.ai.api_base
+    so concurrent requests reuse connections instead of blocking the event loop.
+    
+    Returns:
+        The shared httpx.AsyncClient
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        headers = {}
+        if settings.ai.api_key:
+            headers["Authorization"] = f"Bearer {settings.ai.api_key}"
+        
+        _client = httpx.AsyncClient(
+            base_url=settings.ai.api_base,
+            headers=headers,
+            timeout=httpx.Timeout(settings.ai.request_timeout, connect=settings.ai.connect_timeout),
+            limits=httpx.Limits(
+                max_connections=settings.ai.max_connections,
+                max_keepalive_connections=settings.ai.max_keepalive_connections,
+                keepalive_expiry=settings.ai.keepalive_expiry,
+            ),
+        )
+    return _client
+
+
+async def close_client():
+    """Close the shared HTTP client and release its pooled connections"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _post(path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    POST a JSON payload to the AI API and return the decoded response
+    
+    Args:
+        path: Endpoint path relative to the API base (e.g. "/embeddings")
+        payload: JSON request body
+    
+    Returns:
+        Decoded JSON response
+    """
+    with llm_requests_in_flight.track(endpoint=path):
+        response = await get_client().post(path, json=payload)
+    response.raise_for_status()
+    return response.json()
 
-# Initialize OpenAI with API key and base URL
-openai.api_key = settings.ai.api_key
-openai.api_base = settings.ai.api_base
 
 async def embed_text(text: str) -> List[float]:
     """
     Generate an embedding for a single text
     
+    Raises EmbeddingError if the text cannot be embedded.
+    
     Args:
         text: The text to embed
         
     Returns:
         Embedding vector
     """
-    try:
-        response = openai.Embedding.create(
-            model=settings.ai.embedding_model,
-            input=text,
-        )
-        return response["data"][0]["embedding"]
-    except Exception as e:
-        print(f"Error generating embedding: {e}")
-        # Return a zero vector as fallback
-        return [0.0] * 1536  # OpenAI embeddings are 1536-dimensional
+    cached = await embedding_cache.get(settings.ai.embedding_model, text)
+    if cached is not None:
+        return cached
+    
+    # Concurrent requests for the same text share one API call
+    return await embedding_flight.do(
+        f"{settings.ai.embedding_model}:{text_hash(text)}",
+        lambda: _fetch_embedding(text)
+    )
+
+
+async def _fetch_embedding(text: str) -> List[float]:
+    """
+    Get the embedding of a text from the API and cache it
+    
+    Transient errors are retried like embedding batches. Raises
+    EmbeddingError if the text cannot be embedded, rather than returning a
+    placeholder vector that would match no policy sections.
+    """
+    attempt = 0
+    while True:
+        try:
+            response = await _post("/embeddings", {
+                "model": settings.ai.embedding_model,
+                "input": text,
+            })
+            embedding = response["data"][0]["embedding"]
+            break
+        except Exception as e:
+            print(f"Error generating embedding (attempt {attempt + 1}): {e}")
+            if _is_transient(e) and attempt < settings.ai.embedding_max_retries:
+                await asyncio.sleep(settings.ai.embedding_retry_backoff * 2 ** attempt)
+                attempt += 1
+                continue
+            raise EmbeddingError(f"Failed to generate embedding: {e}") from e
+    
+    _record_embedding_tokens(response)
+    await embedding_cache.put(settings.ai.embedding_model, text, embedding)
+    return embedding
+
+
+def _record_embedding_tokens(response: Dict[str, Any]):
+    """Count the input tokens reported by an embeddings response"""
+    tokens = (response.get("usage") or {}).get("prompt_tokens")
+    if tokens:
+        llm_tokens.inc(tokens, kind="embedding")
 
 
-async def embed_documents(documents: List[str]) -> List[List[float]]:
+async def _embed_batch(texts: List[str]) -> List[List[float]]:
+    """
+    Generate embeddings for a batch of texts in a single API call
+    
+    Args:
+        texts: The texts to embed
+    
+    Returns:
+        Embedding vectors in the same order as the texts
+    """
+    with timed("embed_batch"):
+        response = await _post("/embeddings", {
+            "model": settings.ai.embedding_model,
+            "input": texts,
+        })
+    _record_embedding_tokens(response)
+    data = sorted(response["data"], key=lambda item: item.get("index", 0))
+    if len(data) != len(texts):
+        raise EmbeddingError(f"Expected {len(texts)} embeddings, got {len(data)}")
+    return [item["embedding"] for item in data]
+
+
+def _is_transient(error: Exception) -> bool:
+    """Whether a failed API call may succeed if retried (connection errors, 429 and 5xx)"""
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+
+def _is_rejected_input(error: Exception) -> bool:
+    """Whether the API rejected a request for its input (400) or size (413)"""
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code in (400, 413)
+
+
+async def _embed_batch_with_retry(
+    texts: List[str],
+    semaphore: asyncio.Semaphore,
+    retries: Optional[int] = None
+) -> List[List[float]]:
+    """
+    Embed a batch, retrying transient errors and splitting rejected batches
+    
+    Connection errors, 429 and 5xx responses are retried with backoff. A
+    400 or 413 response can be caused by a single bad input or by the size
+    of the batch, so each half is embedded separately. The halves share the
+    retries left, rather than each getting a new budget. Other errors fail
+    the batch immediately.
+    
+    Args:
+        texts: The texts to embed
+        semaphore: Limits the number of batches in flight
+        retries: Retries left (defaults to settings.ai.embedding_max_retries)
+    
+    Returns:
+        Embedding vectors in the same order as the texts
+    """
+    if retries is None:
+        retries = settings.ai.embedding_max_retries
+    
+    attempt = 0
+    while True:
+        try:
+            async with semaphore:
+                return await _embed_batch(texts)
+        except Exception as e:
+            print(f"Error embedding batch of {len(texts)} texts (attempt {attempt + 1}): {e}")
+            if _is_transient(e) and attempt < retries:
+                await asyncio.sleep(settings.ai.embedding_retry_backoff * 2 ** attempt)
+                attempt += 1
+                continue
+            if _is_rejected_input(e) and len(texts) > 1:
+                break
+            raise EmbeddingError(f"Failed to generate embedding: {e}") from e
+    
+    middle = len(texts) // 2
+    left, right = await asyncio.gather(
+        _embed_batch_with_retry(texts[:middle], semaphore, retries - attempt),
+        _embed_batch_with_retry(texts[middle:], semaphore, retries - attempt),
+    )
+    return left + right
+
+
+def _batch_by_tokens(documents: List[str]) -> List[List[str]]:
+    """
+    Group documents into batches bounded by token count and batch size
+    
+    Args:
+        documents: List of text documents
+    
+    Returns:
+        List of batches, preserving document order
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for doc in documents:
+        tokens = count_tokens(doc, settings.ai.embedding_model)
+        if batch and (
+            batch_tokens + tokens > settings.ai.embedding_batch_tokens
+            or len(batch) >= settings.ai.embedding_batch_size
+        ):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(doc)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def embed_documents(documents: List[str], progress: Optional[Callable[[int, int], None]] = None) -> List[List[float]]:
     """
     Generate embeddings for a list of documents
     
+    Cached embeddings are reused. The remaining documents are sent in
+    token-bounded batches with a limited number of batches in flight.
+    Raises EmbeddingError if any document cannot be embedded, rather than
+    storing a placeholder vector.
+    
     Args:
         documents: List of text documents to embed
+        progress: Optional callback called with (documents embedded, total documents)
         
     Returns:
         List of embedding vectors
     """
-    embeddings = []
-    for doc in documents:
-        embedding = await embed_text(doc)
-        embeddings.append(embedding)
-    return embeddings
+    model = settings.ai.embedding_model
+    cached = await embedding_cache.get_many(model, documents)
+    
+    # Only embed distinct texts that are not cached
+    missing = list(dict.fromkeys(
+        doc for doc, embedding in zip(documents, cached) if embedding is None
+    ))
+    
+    semaphore = asyncio.Semaphore(settings.ai.embedding_concurrency)
+    embedded = len(documents) - len(missing)
+    if progress:
+        progress(embedded, len(documents))
+    
+    async def embed_batch(batch: List[str]) -> List[List[float]]:
+        nonlocal embedded
+        batch_embeddings = await _embed_batch_with_retry(batch, semaphore)
+        await embedding_cache.put_many(model, batch, batch_embeddings)
+        embedded += len(batch)
+        if progress:
+            progress(embedded, len(documents))
+        return batch_embeddings
+    
+    batches = _batch_by_tokens(missing)
+    results = await asyncio.gather(*[embed_batch(batch) for batch in batches])
+    
+    new_embeddings = {}
+    for batch, batch_embeddings in zip(batches, results):
+        new_embeddings.update(zip(batch, batch_embeddings))
+    
+    return [
+        embedding if embedding is not None else new_embeddings[doc]
+        for doc, embedding in zip(documents, cached)
+    ]
+
+
+def context_window() -> int:
+    """Get the context window size of the generation model"""
+    return settings.ai.context_window or get_context_window(settings.ai.generation_model)
+
+
+def _count(text: str) -> int:
+    return count_tokens(text, settings.ai.generation_model)
 
 
-async def generate_text(prompt: str, system_message: str = None) -> str:
+def chat_messages(prompt: str, system_message: str = None) -> List[Dict[str, str]]:
     """
-    Generate text using the OpenAI API
+    Build the messages of a single-turn chat request
     
     Args:
         prompt: The user prompt
         system_message: Optional system message to provide context
+    
+    Returns:
+        List of chat messages
+    """
+    messages = []
+    
+    if system_message:
+        messages.append({"role": "system", "content": system_message})
+    
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def _message_tokens(messages: List[Dict[str, str]]) -> int:
+    """Count the tokens of chat messages, including formatting"""
+    return sum(_count(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def max_output_tokens(prompt_tokens: int) -> int:
+    """
+    Size a completion to the part of the context window the prompt leaves free
+    
+    Args:
+        prompt_tokens: Tokens in the request messages
+    
+    Returns:
+        The max_tokens to request, at most settings.ai.max_output_tokens
+    """
+    return max(1, min(settings.ai.max_output_tokens, context_window() - prompt_tokens))
+
+
+def _chat_payload(messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    """
+    Build a chat completions request body
+    
+    Args:
+        messages: The chat messages
+    
+    Returns:
+        JSON request body
+    """
+    return {
+        "model": settings.ai.generation_model,
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": max_output_tokens(_message_tokens(messages)),
+    }
+
+
+async def generate_chat(messages: List[Dict[str, str]], coalesce: bool = False) -> str:
+    """
+    Generate text using the OpenAI-compatible chat completions API
+    
+    Args:
+        messages: The chat messages
+        coalesce: Share one API call with concurrent requests for the same
+            messages, model and parameters (callers asking for fresh content
+            leave this off)
         
     Returns:
         Generated text
     """
+    payload = _chat_payload(messages)
+    with timed("generate_text"):
+        if not coalesce:
+            return await _complete_chat(payload)
+        key = text_hash(json.dumps(payload, sort_keys=True))
+        return await completion_flight.do(key, lambda: _complete_chat(payload))
+
+
+async def _complete_chat(payload: Dict[str, Any]) -> str:
+    """Get a chat completion from the API"""
     try:
-        messages = []
+        response = await _post("/chat/completions", payload)
         
-        if system_message:
-            messages.append({"role": "system", "content": system_message})
-            
-        messages.append({"role": "user", "content": prompt})
-        
-        response = openai.ChatCompletion.create(
-            model=settings.ai.generation_model,
-            messages=messages,
-            temperature=0.7,
-            max_tokens=4000,
+        content = response["choices"][0]["message"]["content"]
+        usage = response.get("usage") or {}
+        record_tokens(
+            usage.get("prompt_tokens") or _message_tokens(payload["messages"]),
+            usage.get("completion_tokens") or _count(content)
         )
-        
-        return response.choices[0].message.content
+        return content
     except Exception as e:
         print(f"Error generating text: {e}")
-        return "Error: Unable to generate text. It appears the policy isn't clear on this matter. Please take appropriate action based on your judgment."
+        return GENERATION_ERROR_MESSAGE
+
+
+async def generate_text(prompt: str, system_message: str = None, coalesce: bool = False) -> str:
+    """
+    Generate text from a single prompt
+    
+    Args:
+        prompt: The user prompt
+        system_message: Optional system message to provide context
+        coalesce: Share one API call with concurrent identical requests
+    
+    Returns:
+        Generated text
+    """
+    return await generate_chat(chat_messages(prompt, system_message), coalesce)
+
+
+async def stream_chat(messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+    """
+    Generate text using the chat completions API in streaming mode
+    
+    Raises GenerationError if the stream reports an error or ends before
+    its "[DONE]" event, so a partial completion is not taken as complete.
+    
+    Args:
+        messages: The chat messages
+    
+    Yields:
+        Pieces of generated text as they arrive
+    """
+    payload = _chat_payload(messages)
+    payload["stream"] = True
+    
+    pieces: List[str] = []
+    accepted = False
+    done = False
+    try:
+        with timed("generate_stream"), llm_requests_in_flight.track(endpoint="/chat/completions"):
+            start = time.perf_counter()
+            async with get_client().stream("POST", "/chat/completions", json=payload) as response:
+                response.raise_for_status()
+                accepted = True
+                async for line in response.aiter_lines():
+                    # Server-sent events: "data: {json}" lines, ending with "data: [DONE]"
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        done = True
+                        break
+                    
+                    event = json.loads(data)
+                    if event.get("error"):
+                        raise GenerationError(f"Completion stream failed: {event['error']}")
+                    choices = event.get("choices") or []
+                    if choices:
+                        content = (choices[0].get("delta") or {}).get("content")
+                        if content:
+                            if not pieces:
+                                llm_first_token_seconds.observe(time.perf_counter() - start)
+                            pieces.append(content)
+                            yield content
+        if not done:
+            raise GenerationError("Completion stream ended before it was complete")
+    finally:
+        # Count the tokens also when the client disconnects mid-stream
+        if accepted:
+            record_tokens(_message_tokens(messages), _count("".join(pieces)))
 
 
-async def construct_generation_prompt(filled_template: str, policy_chunks: List[Dict[str, Any]]) -> str:
+async def stream_text(prompt: str, system_message: str = None) -> AsyncIterator[str]:
+    """
+    Stream text generated from a single prompt
+    
+    Args:
+        prompt: The user prompt
+        system_message: Optional system message to provide context
+    
+    Yields:
+        Pieces of generated text as they arrive
+    """
+    async for piece in stream_chat(chat_messages(prompt, system_message)):
+        yield piece
+
+
+def _prompt_budget(frame: List[Dict[str, str]]) -> int:
+    """
+    Get the tokens left for policy sections in a request
+    
+    Args:
+        frame: The request messages without the policy sections
+    
+    Returns:
+        Tokens available, keeping settings.ai.reserved_output_tokens free for the response
+    """
+    return context_window() - settings.ai.reserved_output_tokens - _message_tokens(frame)
+
+
+def fit_policy_chunks(policy_chunks: List[Dict[str, Any]], budget: int) -> Tuple[List[str], int, int]:
+    """
+    Select the highest-scoring policy chunks that fit in a token budget
+    
+    Chunks are taken in order of score. A chunk that does not fit is trimmed
+    to the remaining budget if at least MIN_CHUNK_TOKENS are left, and
+    dropped otherwise.
+    
+    Args:
+        policy_chunks: Retrieved chunks with text, policy_name and score
+        budget: Tokens available for the policy sections
+    
+    Returns:
+        Tuple of (formatted sections, chunks dropped, chunks trimmed)
+    """
+    model = settings.ai.generation_model
+    sections = []
+    dropped = 0
+    trimmed = 0
+    remaining = budget
+    
+    for chunk in sorted(policy_chunks, key=lambda c: c.get("score", 0.0), reverse=True):
+        section = f"From {chunk['policy_name']}:\n{chunk['text']}"
+        # Sections are joined by a blank line
+        tokens = count_tokens(section, model) + 1
+        
+        if tokens <= remaining:
+            sections.append(section)
+            remaining -= tokens
+        elif remaining >= MIN_CHUNK_TOKENS:
+            sections.append(truncate_tokens(section, remaining - 1, model))
+            remaining = 0
+            trimmed += 1
+        else:
+            dropped += 1
+    
+    return sections, dropped, trimmed
+
+
+async def construct_generation_prompt(
+    filled_template: str,
+    policy_chunks: List[Dict[str, Any]],
+    system_message: str = None
+) -> str:
     """
     Construct a prompt for the text generation model
     
+    Policy chunks are fitted into the context window left after the request
+    and instructions, dropping or trimming the lowest-scoring ones.
+    
     Args:
         filled_template: The template filled with user inputs
         policy_chunks: Relevant policy document chunks
+        system_message: The system message the prompt is sent with
         
     Returns:
         Constructed prompt
     """
-    policy_text = "\n\n".join([
-        f"From {chunk['policy_name']}:\n{chunk['text']}" 
-        for chunk in policy_chunks
-    ])
+    frame = GENERATION_PROMPT.format(filled_template=filled_template, policy_text="")
+    sections, dropped, trimmed = fit_policy_chunks(policy_chunks, _prompt_budget(chat_messages(frame, system_message)))
+    policy_text = "\n\n".join(sections)
     
     if not policy_text.strip():
         policy_text = "No relevant policy information found. Please note this in the response."
     
-    prompt = f"""USER REQUEST:
-{filled_template}
+    request_tokens = _count(filled_template)
+    prompt_stats.record("generation", {
+        "system": _count(system_message or ""),
+        "request": request_tokens,
+        "policy_sections": _count(policy_text),
+        "instructions": _count(frame) - request_tokens,
+    }, dropped, trimmed)
+    
+    return GENERATION_PROMPT.format(filled_template=filled_template, policy_text=policy_text)
 
-RELEVANT POLICY SECTIONS:
-{policy_text}
 
-Please generate a well-formatted, policy-compliant document based on the user's request.
-Ensure that all information complies with the provided policy sections.
-If the policy is unclear or missing relevant information, please indicate this in your response.
-"""
-    return prompt
+def _turn_messages(turns: List[RefinementTurn]) -> List[Dict[str, str]]:
+    """Build the feedback and revision messages of earlier refinement turns"""
+    messages = []
+    for turn in turns:
+        prompt = REFINEMENT_SUMMARY_PROMPT if turn.compacted else REFINEMENT_FEEDBACK_PROMPT
+        messages.append({"role": "user", "content": prompt.format(feedback=turn.feedback)})
+        # A summary whose document did not fit the history budget has no content
+        if turn.content:
+            messages.append({"role": "assistant", "content": turn.content})
+    return messages
 
 
-async def construct_refinement_prompt(original_content: str, feedback: str, context: Dict[str, Any]) -> str:
+def compact_refinement_turns(turns: List[RefinementTurn], budget: Optional[int] = None) -> List[RefinementTurn]:
     """
-    Construct a prompt for refining the generated content
+    Compact older refinement turns once the history is over its token budget
+    
+    The most recent turns (up to settings.ai.refinement_keep_turns, fewer if
+    they alone are over budget) are kept. The older ones are replaced by one
+    compacted turn listing their last MAX_SUMMARY_FEEDBACK feedback requests,
+    with the document as it stood after them, truncated to the budget the
+    kept turns leave, or left out if less than MIN_CHUNK_TOKENS remain.
     
     Args:
-        original_content: The originally generated content
-        feedback: User feedback for refinement
-        context: Original request context (filled template, policy chunks)
-        
+        turns: Refinement turns, oldest first
+        budget: Token budget of the history (defaults to settings.ai.refinement_history_tokens)
+    
     Returns:
-        Constructed prompt
+        The turns, compacted if they are over the budget
     """
-    prompt = f"""You previously generated this document:
-{original_content}
-
-The user has provided the following feedback:
-{feedback}
-
-Original request:
-{context.get('filled_template', 'No original request available')}
+    if budget is None:
+        budget = settings.ai.refinement_history_tokens
+    if len(turns) < 2 or _message_tokens(_turn_messages(turns)) <= budget:
+        return turns
+    
+    keep = min(len(turns) - 1, max(1, settings.ai.refinement_keep_turns))
+    while keep > 1 and _message_tokens(_turn_messages(turns[-keep:])) > budget:
+        keep -= 1
+    older, recent = turns[:-keep], turns[-keep:]
+    
+    feedback = []
+    for turn in older:
+        if turn.compacted:
+            feedback.extend(turn.feedback.splitlines())
+        else:
+            feedback.append("- " + " ".join(turn.feedback.split()))
+    
+    summary = RefinementTurn(
+        feedback="\n".join(feedback[-MAX_SUMMARY_FEEDBACK:]),
+        content="",
+        refined_at=older[-1].refined_at,
+        compacted=True
+    )
+    
+    # Fit the summary's document into what the kept turns leave of the budget
+    available = budget - _message_tokens(_turn_messages([summary] + recent)) - MESSAGE_OVERHEAD_TOKENS
+    if available >= MIN_CHUNK_TOKENS:
+        summary.content = truncate_tokens(older[-1].content, available, settings.ai.generation_model)
+        # Token counts of truncated text can differ slightly from the target
+        overflow = _message_tokens(_turn_messages([summary] + recent)) - budget
+        if overflow > 0:
+            summary.content = truncate_tokens(summary.content, available - overflow, settings.ai.generation_model)
+    return [summary] + recent
 
-Relevant policy sections:
-{context.get('policy_sections', 'No policy sections available')}
 
-Please refine the document based on the user's feedback while ensuring it remains compliant with policy.
-"""
-    return prompt 
\ No newline at end of file
+async def construct_refinement_messages(
+    original_content: str,
+    turns: List[RefinementTurn],
+    feedback: str,
+    context: Dict[str, Any],
+    system_message: str = None
+) -> List[Dict[str, str]]:
+    """
+    Construct the chat messages for a refinement turn
+    
+    The system message, the original request with its policy sections and
+    the first draft lead every turn of a session unchanged, so the model
+    server can reuse their cached prefix. The policy sections are truncated
+    to a budget that leaves room for settings.ai.refinement_history_tokens
+    of history, but keep at least settings.ai.refinement_min_policy_tokens;
+    if the history then does not fit, it is compacted further for this
+    request. Earlier turns follow as feedback and revision pairs.
+    
+    Args:
+        original_content: The originally generated content
+        turns: Earlier refinement turns, oldest first
+        feedback: User feedback for this refinement
+        context: Original request context (filled template, policy sections)
+        system_message: The system message
+        
+    Returns:
+        List of chat messages
+    """
+    filled_template = context.get('filled_template', 'No original request available')
+    policy_sections = context.get('policy_sections', 'No policy sections available')
+    draft = {"role": "assistant", "content": original_content}
+    
+    frame = chat_messages(
+        REFINEMENT_CONTEXT_PROMPT.format(filled_template=filled_template, policy_sections=""),
+        system_message
+    ) + [draft]
+    available = _prompt_budget(frame)
+    budget = max(
+        available - settings.ai.refinement_history_tokens,
+        min(settings.ai.refinement_min_policy_tokens, available)
+    )
+    truncated = truncate_tokens(policy_sections, budget, settings.ai.generation_model)
+    
+    prefix = chat_messages(
+        REFINEMENT_CONTEXT_PROMPT.format(filled_template=filled_template, policy_sections=truncated),
+        system_message
+    ) + [draft]
+    request = [{"role": "user", "content": REFINEMENT_FEEDBACK_PROMPT.format(feedback=feedback)}]
+    
+    # Compact the history further rather than drop the policy grounding
+    history_budget = available - _count(truncated) - _message_tokens(request)
+    if _message_tokens(_turn_messages(turns)) > history_budget:
+        turns = compact_refinement_turns(turns, history_budget)
+    history = _turn_messages(turns)
+    
+    prefix_tokens = _message_tokens(prefix)
+    prompt_stats.record("refinement", {
+        "prefix": prefix_tokens,
+        "policy_sections": _count(truncated),
+        "history": _message_tokens(history),
+        "feedback": _message_tokens(request),
+    }, trimmed=int(truncated != policy_sections))
+    
+    return prefix + history + request
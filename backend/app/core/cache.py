@@ -0,0 +1,364 @@
+import os
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Set, Callable, Awaitable
+from app.core.config import settings
+
+def text_hash(text: str) -> str:
+    """Get the SHA-256 hex digest of a text"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache keyed by (embedding model, SHA-256 of the text)
+    
+    An in-process LRU bounded by memory sits in front of a SQLite store, so
+    embeddings survive restarts and are shared by workers on the same volume.
+    Vectors are stored as float32.
+    """
+    
+    def __init__(self, path: str, max_memory_bytes: int):
+        self.path = path
+        self.max_memory_bytes = max_memory_bytes
+        self.memory: "OrderedDict[Tuple[str, str], array]" = OrderedDict()
+        self.memory_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+    
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        """Open the SQLite store on first use"""
+        if not self.path:
+            return None
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, text_hash)) WITHOUT ROWID"
+            )
+            self._connection = connection
+        return self._connection
+    
+    def _remember(self, key: Tuple[str, str], vector: array):
+        """Add a vector to the in-memory LRU, evicting the oldest entries over the cap"""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = vector
+        self.memory_bytes += vector.itemsize * len(vector)
+        while self.memory_bytes > self.max_memory_bytes and self.memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.itemsize * len(evicted)
+    
+    def _read_disk(self, model: str, hashes: List[str]) -> Dict[str, array]:
+        """Read vectors for the given text hashes from the SQLite store"""
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return found
+            # Stay well below SQLite's bound parameter limit
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                rows = connection.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                    f"AND text_hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch]
+                )
+                for hash_value, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[hash_value] = vector
+        return found
+    
+    def _write_disk(self, model: str, entries: List[Tuple[str, array]]):
+        """Write vectors to the SQLite store"""
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                    [(model, hash_value, vector.tobytes()) for hash_value, vector in entries]
+                )
+    
+    async def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Look up cached embeddings
+        
+        Args:
+            model: The embedding model
+            texts: The texts to look up
+        
+        Returns:
+            Embedding for each text, or None where it is not cached
+        """
+        hashes = [text_hash(text) for text in texts]
+        vectors: Dict[str, array] = {}
+        for hash_value in hashes:
+            key = (model, hash_value)
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                vectors[hash_value] = self.memory[key]
+        
+        missing = [hash_value for hash_value in set(hashes) if hash_value not in vectors]
+        if missing:
+            try:
+                disk_vectors = await asyncio.to_thread(self._read_disk, model, missing)
+            except Exception as e:
+                print(f"Error reading embedding cache: {e}")
+                disk_vectors = {}
+            for hash_value, vector in disk_vectors.items():
+                self._remember((model, hash_value), vector)
+            vectors.update(disk_vectors)
+        else:
+            disk_vectors = {}
+        
+        results = []
+        for hash_value in hashes:
+            vector = vectors.get(hash_value)
+            if vector is None:
+                self.misses += 1
+                results.append(None)
+            else:
+                if hash_value in disk_vectors:
+                    self.disk_hits += 1
+                else:
+                    self.memory_hits += 1
+                results.append(vector.tolist())
+        return results
+    
+    async def get(self, model: str, text: str) -> Optional[List[float]]:
+        """Look up the cached embedding of a single text"""
+        return (await self.get_many(model, [text]))[0]
+    
+    async def put_many(self, model: str, texts: List[str], embeddings: List[List[float]]):
+        """
+        Store embeddings in both cache tiers
+        
+        Args:
+            model: The embedding model
+            texts: The embedded texts
+            embeddings: Embedding vector for each text
+        """
+        entries = [(text_hash(text), array("f", embedding)) for text, embedding in zip(texts, embeddings)]
+        for hash_value, vector in entries:
+            self._remember((model, hash_value), vector)
+        try:
+            await asyncio.to_thread(self._write_disk, model, entries)
+        except Exception as e:
+            print(f"Error writing embedding cache: {e}")
+    
+    async def put(self, model: str, text: str, embedding: List[float]):
+        """Store the embedding of a single text"""
+        await self.put_many(model, [text], [embedding])
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get cache hit/miss counters and memory usage"""
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "hits": hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+        }
+    
+    def close(self):
+        """Close the SQLite store"""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class ResultCache:
+    """
+    In-process LRU cache with a time-to-live and tag-based invalidation
+    
+    Entries are tagged (e.g. with the template and policies they depend on)
+    so every entry derived from a changed object can be dropped at once.
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[str, Tuple[float, Any, Tuple[str, ...]]]" = OrderedDict()
+        self.tags: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def _remove(self, key: str):
+        _, _, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+    
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Look up a cached value
+        
+        Args:
+            key: The cache key
+        
+        Returns:
+            The cached value, or None if it is missing or expired
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    
+    def put(self, key: str, value: Any, tags: Iterable[str] = ()):
+        """
+        Cache a value, evicting the least recently used entries over the limit
+        
+        Args:
+            key: The cache key
+            value: The value to cache
+            tags: Tags the entry can be invalidated by
+        """
+        if self.max_entries <= 0:
+            return
+        if key in self.entries:
+            self._remove(key)
+        
+        tags = tuple(tags)
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value, tags)
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(key)
+        
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+    
+    def invalidate(self, tag: str) -> int:
+        """
+        Drop every entry with a tag
+        
+        Args:
+            tag: The tag to invalidate
+        
+        Returns:
+            Number of entries dropped
+        """
+        keys = list(self.tags.get(tag, ()))
+        for key in keys:
+            self._remove(key)
+        self.invalidations += len(keys)
+        return len(keys)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get cache hit/miss counters and size"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "entries": len(self.entries),
+        }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one
+    
+    The first caller for a key starts the call as a task; callers that
+    arrive while it is in flight wait for the same task and get its result
+    or exception. A waiter that is cancelled leaves the task running for the
+    others. Nothing is kept once the call finishes, so this only shares
+    work between calls that overlap in time.
+    """
+    
+    def __init__(self):
+        self.in_flight: Dict[str, asyncio.Task] = {}
+        self.calls = 0
+        self.coalesced = 0
+    
+    def _finished(self, key: str, task: asyncio.Task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        # Mark the exception as retrieved in case every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+    
+    async def do(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run a call, or join the identical call already in flight
+        
+        Args:
+            key: Identifies calls that produce the same result
+            call: Starts the call when none is in flight for the key
+        
+        Returns:
+            The result of the call
+        """
+        task = self.in_flight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(call())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda task: self._finished(key, task))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get the number of calls made and of calls saved by joining one in flight"""
+        requests = self.calls + self.coalesced
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "coalesced_rate": self.coalesced / requests if requests else 0.0,
+            "in_flight": len(self.in_flight),
+        }
+
+
+# Shared embedding cache
+embedding_cache = EmbeddingCache(
+    path=settings.cache.embedding_path,
+    max_memory_bytes=settings.cache.embedding_memory_mb * 1024 * 1024
+)
+
+# Cache of generated documents for identical generation requests
+generation_cache = ResultCache(
+    max_entries=settings.cache.generation_max_entries,
+    ttl_seconds=settings.cache.generation_ttl_seconds
+)
+
+# Policy chunk texts by point ID, shared by the documents that reference them
+chunk_cache = ResultCache(
+    max_entries=settings.cache.chunk_max_entries,
+    ttl_seconds=settings.cache.chunk_ttl_seconds
+)
+
+# In-flight embedding, chat completion and generation pipeline calls
+embedding_flight = SingleFlight()
+completion_flight = SingleFlight()
+generation_flight = SingleFlight()
@@ -10,16 +10,133 @@ class AISettings(BaseModel):
     api_base: str = os.getenv("OPENAI_API_BASE", "http://openai-api:8000/v1")
     embedding_model: str = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
     generation_model: str = os.getenv("GENERATION_MODEL", "gpt-3.5-turbo")
+    # Shared HTTP connection pool to the OpenAI-compatible endpoint
+    max_connections: int = int(os.getenv("AI_MAX_CONNECTIONS", "100"))
+    max_keepalive_connections: int = int(os.getenv("AI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+    keepalive_expiry: float = float(os.getenv("AI_KEEPALIVE_EXPIRY", "30"))
+    connect_timeout: float = float(os.getenv("AI_CONNECT_TIMEOUT", "10"))
+    request_timeout: float = float(os.getenv("AI_REQUEST_TIMEOUT", "120"))
+    # Batched embedding of document chunks
+    embedding_batch_tokens: int = int(os.getenv("EMBEDDING_BATCH_TOKENS", "8000"))
+    embedding_batch_size: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "128"))
+    embedding_concurrency: int = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+    embedding_max_retries: int = int(os.getenv("EMBEDDING_MAX_RETRIES", "3"))
+    embedding_retry_backoff: float = float(os.getenv("EMBEDDING_RETRY_BACKOFF", "0.5"))
+    # Batch generation
+    generation_batch_max_items: int = int(os.getenv("GENERATION_BATCH_MAX_ITEMS", "100"))
+    generation_batch_concurrency: int = int(os.getenv("GENERATION_BATCH_CONCURRENCY", "8"))
+    # Prompt token budget: context window of the generation model (0 to look it up
+    # from the model name), the most tokens to request, and the tokens always
+    # left free for the response when fitting policy sections into the prompt
+    context_window: int = int(os.getenv("AI_CONTEXT_WINDOW", "0"))
+    max_output_tokens: int = int(os.getenv("AI_MAX_OUTPUT_TOKENS", "4000"))
+    reserved_output_tokens: int = int(os.getenv("AI_RESERVED_OUTPUT_TOKENS", "1024"))
+    # Refinement sessions: tokens of earlier turns kept before older turns are
+    # compacted into a summary, the most recent turns always kept verbatim, and
+    # the tokens of policy sections kept even if history must be compacted further
+    refinement_history_tokens: int = int(os.getenv("REFINEMENT_HISTORY_TOKENS", "3000"))
+    refinement_keep_turns: int = int(os.getenv("REFINEMENT_KEEP_TURNS", "2"))
+    refinement_min_policy_tokens: int = int(os.getenv("REFINEMENT_MIN_POLICY_TOKENS", "1000"))
 
 class VectorDBSettings(BaseModel):
+    # "qdrant", or "local" for an in-process index memory-mapped from local_path
+    backend: str = os.getenv("VECTOR_BACKEND", "qdrant")
+    local_path: str = os.getenv(
+        "VECTOR_INDEX_PATH",
+        os.path.join(os.getenv("UPLOAD_DIR", "/app/uploads"), ".vectors")
+    )
     host: str = os.getenv("QDRANT_HOST", "qdrant")
+    # Run Qdrant in-process instead of connecting to host: ":memory:" or a
+    # directory path (for tests and load tests; a single worker only)
+    location: str = os.getenv("QDRANT_LOCATION", "")
     port: int = int(os.getenv("QDRANT_PORT", "6333"))
     collection_name: str = os.getenv("QDRANT_COLLECTION", "policies")
+    # Async client; gRPC is used for point operations when preferred
+    grpc_port: int = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+    prefer_grpc: bool = os.getenv("QDRANT_PREFER_GRPC", "True").lower() == "true"
+    timeout: int = int(os.getenv("QDRANT_TIMEOUT", "30"))
+    # Upserts are split into batches of points sent with limited parallelism;
+    # with upsert_wait off, Qdrant acknowledges batches before indexing them
+    upsert_batch_size: int = int(os.getenv("QDRANT_UPSERT_BATCH_SIZE", "256"))
+    upsert_concurrency: int = int(os.getenv("QDRANT_UPSERT_CONCURRENCY", "4"))
+    upsert_wait: bool = os.getenv("QDRANT_UPSERT_WAIT", "True").lower() == "true"
+    # HNSW index of new collections, and the search beam width (0 for the server default)
+    hnsw_m: int = int(os.getenv("QDRANT_HNSW_M", "16"))
+    hnsw_ef_construct: int = int(os.getenv("QDRANT_HNSW_EF_CONSTRUCT", "100"))
+    search_ef: int = int(os.getenv("QDRANT_SEARCH_EF", "0"))
+    # Scalar (int8) quantization of new collections; searches rescore with the
+    # original vectors after oversampling the quantized candidates
+    quantization: bool = os.getenv("QDRANT_QUANTIZATION", "False").lower() == "true"
+    quantization_always_ram: bool = os.getenv("QDRANT_QUANTIZATION_ALWAYS_RAM", "True").lower() == "true"
+    quantization_oversampling: float = float(os.getenv("QDRANT_QUANTIZATION_OVERSAMPLING", "2.0"))
 
 class RAGSettings(BaseModel):
     chunk_size: int = int(os.getenv("CHUNK_SIZE", "1000"))
     chunk_overlap: int = int(os.getenv("CHUNK_OVERLAP", "200"))
     results_count: int = int(os.getenv("RESULTS_COUNT", "3"))
+    # Optional re-ranking: fetch mmr_candidates chunks and pick results_count of them
+    # by maximal marginal relevance (mmr_diversity from 0 = relevance only to 1)
+    mmr: bool = os.getenv("RAG_MMR", "False").lower() == "true"
+    mmr_candidates: int = int(os.getenv("RAG_MMR_CANDIDATES", "20"))
+    mmr_diversity: float = float(os.getenv("RAG_MMR_DIVERSITY", "0.3"))
+    # Optional merging of retrieved chunks that are consecutive in the same policy document
+    merge_adjacent: bool = os.getenv("RAG_MERGE_ADJACENT", "False").lower() == "true"
+
+class OCRSettings(BaseModel):
+    # Number of OCR worker processes (0 = one per available core)
+    workers: int = int(os.getenv("OCR_WORKERS", "0"))
+    # Pages rasterized together by a worker; bounds peak memory per worker
+    window_pages: int = int(os.getenv("OCR_WINDOW_PAGES", "4"))
+    dpi: int = int(os.getenv("OCR_DPI", "200"))
+    # Use the PDF's embedded text layer and only OCR pages without usable text
+    use_text_layer: bool = os.getenv("OCR_USE_TEXT_LAYER", "True").lower() == "true"
+    min_text_chars: int = int(os.getenv("OCR_MIN_TEXT_CHARS", "20"))
+
+class IngestionSettings(BaseModel):
+    # Number of policy documents processed concurrently
+    workers: int = int(os.getenv("INGESTION_WORKERS", "2"))
+    # Maximum number of jobs waiting in the queue
+    max_queued: int = int(os.getenv("INGESTION_MAX_QUEUED", "100"))
+
+class CacheSettings(BaseModel):
+    # In-process LRU of embeddings, bounded by memory
+    embedding_memory_mb: int = int(os.getenv("EMBEDDING_CACHE_MEMORY_MB", "64"))
+    # SQLite file backing the embedding cache (empty to disable the disk tier)
+    embedding_path: str = os.getenv(
+        "EMBEDDING_CACHE_PATH",
+        os.path.join(os.getenv("UPLOAD_DIR", "/app/uploads"), ".embeddings.sqlite3")
+    )
+    # Exact-match cache of generated documents
+    generation_max_entries: int = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", "1000"))
+    generation_ttl_seconds: int = int(os.getenv("GENERATION_CACHE_TTL_SECONDS", "3600"))
+    # Policy chunk texts shared by the documents that reference them
+    chunk_max_entries: int = int(os.getenv("CHUNK_CACHE_MAX_ENTRIES", "5000"))
+    chunk_ttl_seconds: int = int(os.getenv("CHUNK_CACHE_TTL_SECONDS", "3600"))
+
+class StorageSettings(BaseModel):
+    # "sqlite" for durable storage shared by all workers, "memory" for a per-process store
+    backend: str = os.getenv("STORAGE_BACKEND", "sqlite")
+    path: str = os.getenv(
+        "DATABASE_PATH",
+        os.path.join(os.getenv("UPLOAD_DIR", "/app/uploads"), ".app.sqlite3")
+    )
+    # Generated documents expire after this long without being read or refined
+    document_ttl_seconds: int = int(os.getenv("DOCUMENT_TTL_SECONDS", str(7 * 24 * 3600)))
+    # Generated documents kept in memory by the "memory" backend
+    document_max_entries: int = int(os.getenv("DOCUMENT_MAX_ENTRIES", "1000"))
+    # SQLite file the "memory" backend spills evicted documents to (empty to drop them)
+    document_spill_path: str = os.getenv("DOCUMENT_SPILL_PATH", "")
+
+class StartupSettings(BaseModel):
+    # Attempts to initialize the vector database at startup (0 to keep retrying),
+    # with exponential backoff between them
+    init_max_attempts: int = int(os.getenv("STARTUP_INIT_MAX_ATTEMPTS", "0"))
+    init_backoff: float = float(os.getenv("STARTUP_INIT_BACKOFF", "0.5"))
+    init_max_backoff: float = float(os.getenv("STARTUP_INIT_MAX_BACKOFF", "30"))
+
+class MetricsSettings(BaseModel):
+    # Add a Server-Timing header with the stage durations of each request
+    timing_header: bool = os.getenv("METRICS_TIMING_HEADER", "False").lower() == "true"
 
 class Settings(BaseModel):
     app_name: str = "Prompt Template System"
@@ -29,8 +146,11 @@ class Settings(BaseModel):
     ai: AISettings = AISettings()
     vector_db: VectorDBSettings = VectorDBSettings()
     rag: RAGSettings = RAGSettings()
+    ocr: OCRSettings = OCRSettings()
+    ingestion: IngestionSettings = IngestionSettings()
+    cache: CacheSettings = CacheSettings()
+    storage: StorageSettings = StorageSettings()
+    startup: StartupSettings = StartupSettings()
+    metrics: MetricsSettings = MetricsSettings()
 
 settings = Settings()
-
-# Ensure upload directory exists
-os.makedirs(settings.upload_dir, exist_ok=True) 
\ No newline at end of file
@@ -1,80 +1,168 @@
+import asyncio
 import hashlib
-from typing import List, Dict, Any, Optional
-import qdrant_client
+from typing import List, Dict, Any, Optional, Callable
+from qdrant_client import AsyncQdrantClient
 from qdrant_client.http import models
 from app.core.config import settings
+from app.core.metrics import timed
+from app.core.vector_index import LocalVectorIndex, point_id
+from app.utils.retrieval import mmr_select, merge_adjacent_chunks
 
-# Initialize Qdrant client
-qdrant_client = qdrant_client.QdrantClient(
-    host=settings.vector_db.host,
-    port=settings.vector_db.port
-)
+# Shared async Qdrant client, created on first use
+_client: Optional[AsyncQdrantClient] = None
+
+# In-process index used instead of Qdrant when settings.vector_db.backend is "local"
+_local_index: Optional[LocalVectorIndex] = None
+
+# Payload fields searches and deletes filter on
+INDEXED_FIELDS = ["policy_hash"]
+SEARCH_PAYLOAD = ["text", "policy_name", "policy_hash", "chunk_index"]
+
+def quantization_config() -> Optional[models.ScalarQuantization]:
+    """Get the scalar quantization config for new collections, if enabled"""
+    if not settings.vector_db.quantization:
+        return None
+    return models.ScalarQuantization(
+        scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8,
+            always_ram=settings.vector_db.quantization_always_ram
+        )
+    )
+
+def search_params() -> Optional[models.SearchParams]:
+    """Get the HNSW and quantization parameters for searches"""
+    vector_db = settings.vector_db
+    if not vector_db.search_ef and not vector_db.quantization:
+        return None
+    return models.SearchParams(
+        hnsw_ef=vector_db.search_ef or None,
+        quantization=models.QuantizationSearchParams(
+            rescore=True,
+            oversampling=vector_db.quantization_oversampling
+        ) if vector_db.quantization else None
+    )
+
+def get_qdrant_client() -> AsyncQdrantClient:
+    """
+    Get the shared async Qdrant client
+    
+    Point operations go over gRPC when settings.vector_db.prefer_grpc is set,
+    which avoids large JSON request bodies for vectors. With
+    settings.vector_db.location, Qdrant runs in-process instead.
+    
+    Returns:
+        The shared AsyncQdrantClient
+    """
+    global _client
+    if _client is None:
+        location = settings.vector_db.location
+        if location == ":memory:":
+            _client = AsyncQdrantClient(location=location)
+        elif location:
+            _client = AsyncQdrantClient(path=location)
+        else:
+            _client = AsyncQdrantClient(
+                host=settings.vector_db.host,
+                port=settings.vector_db.port,
+                grpc_port=settings.vector_db.grpc_port,
+                prefer_grpc=settings.vector_db.prefer_grpc,
+                timeout=settings.vector_db.timeout
+            )
+    return _client
+
+def get_local_index() -> Optional[LocalVectorIndex]:
+    """
+    Get the in-process vector index, if it is the configured backend
+    
+    Returns:
+        The shared LocalVectorIndex, or None when Qdrant is used
+    """
+    global _local_index
+    if settings.vector_db.backend != "local":
+        return None
+    if _local_index is None:
+        _local_index = LocalVectorIndex(settings.vector_db.local_path)
+    return _local_index
+
+async def close_qdrant_client():
+    """Close the shared Qdrant client"""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
 
 # Create collection if it doesn't exist
-def init_collection():
-    """Initialize the vector database collection"""
+async def init_collection() -> bool:
+    """
+    Initialize the vector database collection and its payload indexes
+    
+    Returns:
+        True if the collection is ready, False if Qdrant could not be reached
+    """
+    if get_local_index() is not None:
+        return True
+    
+    qdrant_client = get_qdrant_client()
     try:
-        collections_response = qdrant_client.get_collections()
+        collections_response = await qdrant_client.get_collections()
         collection_names = [collection.name for collection in collections_response.collections]
         
         if settings.vector_db.collection_name not in collection_names:
             vector_size = 1536  # Size for OpenAI embeddings
             
-            qdrant_client.create_collection(
+            await qdrant_client.create_collection(
                 collection_name=settings.vector_db.collection_name,
                 vectors_config=models.VectorParams(
                     size=vector_size,
                     distance=models.Distance.COSINE
-                )
+                ),
+                hnsw_config=models.HnswConfigDiff(
+                    m=settings.vector_db.hnsw_m,
+                    ef_construct=settings.vector_db.hnsw_ef_construct
+                ),
+                quantization_config=quantization_config()
             )
-            
-            # Create index for the policy_hash field
-            qdrant_client.create_payload_index(
+        
+        # Keyword indexes for the filtered fields; creating an existing index is a no-op
+        for field_name in INDEXED_FIELDS:
+            await qdrant_client.create_payload_index(
                 collection_name=settings.vector_db.collection_name,
-                field_name="policy_hash",
+                field_name=field_name,
                 field_schema=models.PayloadSchemaType.KEYWORD
             )
     except Exception as e:
         print(f"Error initializing Qdrant collection: {e}")
+        return False
+    return True
 
 
-async def store_embeddings(policy_id: str, policy_name: str, file_path: str, chunks: List[str], embeddings: List[List[float]]):
+def build_points(
+    content_hash: str,
+    policy_id: str,
+    policy_name: str,
+    file_path: str,
+    chunks: List[str],
+    embeddings: List[List[float]]
+) -> List[models.PointStruct]:
     """
-    Store document chunks and embeddings in the vector database
+    Build the Qdrant points of a document's chunks
     
     Args:
-        policy_id: The ID of the policy document
+        content_hash: SHA-256 of the document file
+        policy_id: The ID of the policy document that first uploaded it
         policy_name: The name of the policy document
         file_path: Path to the original document
         chunks: List of text chunks from the document
         embeddings: List of embedding vectors for each chunk
-    """
-    # Create a hash of the document content to check for duplicates
-    content_hash = hashlib.md5(''.join(chunks).encode()).hexdigest()
-    
-    # Check if this document already exists
-    search_result = qdrant_client.scroll(
-        collection_name=settings.vector_db.collection_name,
-        scroll_filter=models.Filter(
-            must=[
-                models.FieldCondition(
-                    key="policy_hash",
-                    match=models.MatchValue(value=content_hash)
-                )
-            ]
-        ),
-        limit=1
-    )
     
-    if search_result[0]:  # Document with this hash already exists
-        return content_hash
-    
-    # Prepare points for insertion
+    Returns:
+        One point per chunk
+    """
     points = []
     for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
         points.append(
             models.PointStruct(
-                id=f"{policy_id}_{i}",
+                id=point_id(content_hash, i),
                 vector=embedding,
                 payload={
                     "policy_id": policy_id,
@@ -86,27 +174,140 @@ async def store_embeddings(policy_id: str, policy_name: str, file_path: str, chu
                 }
             )
         )
+    return points
+
+async def store_embeddings(
+    content_hash: str,
+    policy_id: str,
+    policy_name: str,
+    file_path: str,
+    chunks: List[str],
+    embeddings: List[List[float]],
+    progress: Optional[Callable[[int, int], None]] = None
+):
+    """
+    Store document chunks and embeddings in the vector database
     
-    # Insert points
-    qdrant_client.upsert(
-        collection_name=settings.vector_db.collection_name,
-        points=points
-    )
+    Points are keyed by the document's content hash, so every policy record
+    with the same file contents shares one embedded copy. They are upserted
+    in batches of settings.vector_db.upsert_batch_size, with at most
+    settings.vector_db.upsert_concurrency batches in flight. If a batch
+    fails, the others are cancelled and awaited before the error is raised.
+    
+    Args:
+        content_hash: SHA-256 of the document file
+        policy_id: The ID of the policy document that first uploaded it
+        policy_name: The name of the policy document
+        file_path: Path to the original document
+        chunks: List of text chunks from the document
+        embeddings: List of embedding vectors for each chunk
+        progress: Optional callback called with (points upserted, total points)
+    """
+    local_index = get_local_index()
+    if local_index is not None:
+        with timed("upsert_batch"):
+            await asyncio.to_thread(
+                local_index.add_document, content_hash, policy_id, policy_name, file_path, chunks, embeddings
+            )
+        if progress:
+            progress(len(chunks), len(chunks))
+        return content_hash
+    
+    points = build_points(content_hash, policy_id, policy_name, file_path, chunks, embeddings)
+    
+    # Insert points in batches
+    batch_size = max(1, settings.vector_db.upsert_batch_size)
+    semaphore = asyncio.Semaphore(max(1, settings.vector_db.upsert_concurrency))
+    upserted = 0
+    
+    async def upsert_batch(batch: List[models.PointStruct]):
+        nonlocal upserted
+        async with semaphore:
+            with timed("upsert_batch"):
+                await get_qdrant_client().upsert(
+                    collection_name=settings.vector_db.collection_name,
+                    points=batch,
+                    wait=settings.vector_db.upsert_wait
+                )
+        upserted += len(batch)
+        if progress:
+            progress(upserted, len(points))
+    
+    tasks = [
+        asyncio.create_task(upsert_batch(points[start:start + batch_size]))
+        for start in range(0, len(points), batch_size)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other batches before the caller cleans up, so that none
+        # lands after the document's points are deleted
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
     
     return content_hash
 
 
+def chunk_digest(text: str) -> str:
+    """Get the hash chunks are matched on across versions of a document"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+async def get_document_vectors(content_hash: str) -> Dict[str, List[float]]:
+    """
+    Get the stored vectors of a document's chunks
+    
+    Args:
+        content_hash: SHA-256 of the document file
+    
+    Returns:
+        Vectors keyed by the chunk_digest of their chunk's text
+    """
+    local_index = get_local_index()
+    if local_index is not None:
+        chunks = await asyncio.to_thread(local_index.get_vectors, content_hash)
+        return {chunk_digest(text): vector for text, vector in chunks}
+    
+    vectors = {}
+    offset = None
+    while True:
+        points, offset = await get_qdrant_client().scroll(
+            collection_name=settings.vector_db.collection_name,
+            scroll_filter=models.Filter(
+                must=[
+                    models.FieldCondition(
+                        key="policy_hash",
+                        match=models.MatchValue(value=content_hash)
+                    )
+                ]
+            ),
+            limit=max(1, settings.vector_db.upsert_batch_size),
+            offset=offset,
+            with_payload=["text"],
+            with_vectors=True
+        )
+        vectors.update((chunk_digest(point.payload["text"]), point.vector) for point in points)
+        if offset is None:
+            return vectors
+
+
 async def get_document_by_hash(hash_value: str) -> Optional[Dict[str, Any]]:
     """
     Get the first document that matches the given hash
     
     Args:
-        hash_value: MD5 hash of the document content
+        hash_value: SHA-256 of the document file
         
     Returns:
         Document metadata or None if not found
     """
-    search_result = qdrant_client.scroll(
+    local_index = get_local_index()
+    if local_index is not None:
+        return await asyncio.to_thread(local_index.get_document, hash_value)
+    
+    search_result = await get_qdrant_client().scroll(
         collection_name=settings.vector_db.collection_name,
         scroll_filter=models.Filter(
             must=[
@@ -116,7 +317,9 @@ async def get_document_by_hash(hash_value: str) -> Optional[Dict[str, Any]]:
                 )
             ]
         ),
-        limit=1
+        limit=1,
+        with_payload=["policy_id", "policy_name", "policy_hash", "file_path"],
+        with_vectors=False
     )
     
     if search_result[0]:
@@ -130,13 +333,28 @@ async def get_document_by_hash(hash_value: str) -> Optional[Dict[str, Any]]:
     return None
 
 
-async def similarity_search(query_vector: List[float], policy_ids: List[str] = None, num_results: int = None):
+def _chunk(point) -> Dict[str, Any]:
+    """Convert a retrieved point to a chunk dict"""
+    return {
+        "id": str(point.id),
+        "text": point.payload["text"],
+        "policy_name": point.payload["policy_name"],
+        "policy_hash": point.payload.get("policy_hash"),
+        "chunk_index": point.payload.get("chunk_index"),
+    }
+
+
+async def similarity_search(query_vector: List[float], policy_hashes: List[str] = None, num_results: int = None):
     """
     Search for similar documents in the vector database
     
+    With settings.rag.mmr, a wider set of candidates is re-ranked by maximal
+    marginal relevance. With settings.rag.merge_adjacent, results that are
+    consecutive chunks of the same document are merged into one.
+    
     Args:
         query_vector: Embedding vector of the search query
-        policy_ids: Optional list of policy IDs to restrict the search to
+        policy_hashes: Optional list of policy content hashes to restrict the search to
         num_results: Number of results to return (default: from settings)
         
     Returns:
@@ -146,52 +364,95 @@ async def similarity_search(query_vector: List[float], policy_ids: List[str] = N
         num_results = settings.rag.results_count
     
     filter_condition = None
-    if policy_ids and len(policy_ids) > 0:
+    if policy_hashes and len(policy_hashes) > 0:
         filter_condition = models.Filter(
-            should=[
+            must=[
                 models.FieldCondition(
-                    key="policy_id",
-                    match=models.MatchValue(value=policy_id)
+                    key="policy_hash",
+                    match=models.MatchAny(any=list(dict.fromkeys(policy_hashes)))
                 )
-                for policy_id in policy_ids
             ]
         )
     
-    search_result = qdrant_client.search(
-        collection_name=settings.vector_db.collection_name,
-        query_vector=query_vector,
-        query_filter=filter_condition,
-        limit=num_results
-    )
+    mmr = settings.rag.mmr
+    limit = max(num_results, settings.rag.mmr_candidates) if mmr else num_results
+    local_index = get_local_index()
+    if local_index is not None:
+        search_result = await asyncio.to_thread(local_index.search, query_vector, policy_hashes, limit, with_vectors=mmr)
+    else:
+        search_result = await get_qdrant_client().search(
+            collection_name=settings.vector_db.collection_name,
+            query_vector=query_vector,
+            query_filter=filter_condition,
+            search_params=search_params(),
+            limit=limit,
+            with_payload=SEARCH_PAYLOAD,
+            with_vectors=mmr
+        )
     
-    return [
-        {
-            "text": point.payload["text"],
-            "policy_name": point.payload["policy_name"],
-            "score": point.score
-        }
-        for point in search_result
-    ]
+    if mmr:
+        selected = mmr_select(
+            query_vector,
+            [point.vector for point in search_result],
+            num_results,
+            settings.rag.mmr_diversity
+        )
+        search_result = [search_result[i] for i in selected]
+    
+    chunks = [{**_chunk(point), "score": point.score} for point in search_result]
+    if settings.rag.merge_adjacent:
+        chunks = merge_adjacent_chunks(chunks, 2 * settings.rag.chunk_overlap)
+    return chunks
+
+
+async def get_chunks(chunk_ids: List[str]):
+    """
+    Fetch stored chunks by point ID
+    
+    Args:
+        chunk_ids: Point IDs of the chunks
+    
+    Returns:
+        List of the chunks that still exist, in the requested order
+    """
+    if not chunk_ids:
+        return []
+    
+    local_index = get_local_index()
+    if local_index is not None:
+        points = await asyncio.to_thread(local_index.retrieve, chunk_ids)
+    else:
+        points = await get_qdrant_client().retrieve(
+            collection_name=settings.vector_db.collection_name,
+            ids=chunk_ids,
+            with_payload=SEARCH_PAYLOAD,
+            with_vectors=False
+        )
+    
+    found = {str(point.id): _chunk(point) for point in points}
+    return [found[chunk_id] for chunk_id in chunk_ids if chunk_id in found]
 
 
-async def delete_document(policy_id: str):
+async def delete_document(content_hash: str):
     """
     Delete all chunks for a document from the vector database
     
     Args:
-        policy_id: ID of the policy document to delete
+        content_hash: Content hash of the policy document to delete
     """
-    qdrant_client.delete(
+    local_index = get_local_index()
+    if local_index is not None:
+        await asyncio.to_thread(local_index.delete_document, content_hash)
+        return
+    
+    await get_qdrant_client().delete(
         collection_name=settings.vector_db.collection_name,
         points_selector=models.Filter(
             must=[
                 models.FieldCondition(
-                    key="policy_id",
-                    match=models.MatchValue(value=policy_id)
+                    key="policy_hash",
+                    match=models.MatchValue(value=content_hash)
                 )
             ]
         )
     )
-
-# Initialize collection on module import
-init_collection() 
\ No newline at end of file
@@ -0,0 +1,507 @@
+import os
+import time
+import fcntl
+import asyncio
+import hashlib
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+from app.db.models import Policy, IngestionJob
+from app.db.repository import db
+from app.core.config import settings
+from app.utils.pdf import process_pdf
+from app.core.ai import embed_documents
+from app.core.cache import generation_cache
+from app.core.database import (
+    store_embeddings, delete_document, get_document_by_hash, get_document_vectors, chunk_digest
+)
+
+class QueueFullError(Exception):
+    """Raised when the ingestion queue cannot accept more jobs"""
+
+# Job queue and worker tasks, created on first submission
+_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+
+# Tasks of the jobs currently being processed, keyed by job ID
+_running: Dict[str, asyncio.Task] = {}
+
+# Jobs are queued in memory, so they only run in the worker process that
+# accepted them. Each process holds a lock on its own worker lock file while
+# its queue runs; a queued or running job whose owner holds no lock was lost
+# when that process stopped.
+WORKER_ID = uuid.uuid4().hex
+_worker_lock: Optional[int] = None
+
+# In-process ingestion locks keyed by lock name, and the number of tasks
+# holding or waiting for each; a lock is dropped once nobody uses it
+_ingest_locks: Dict[str, asyncio.Lock] = {}
+_lock_users: Dict[str, int] = {}
+
+# How often a lock file held by another process is retried (seconds)
+LOCK_POLL_INTERVAL = 0.05
+
+# Progress is saved at most this often per job (seconds); stage and status
+# changes are saved at once
+PROGRESS_SAVE_INTERVAL = 1.0
+
+# How often a worker checks whether its running job was cancelled through
+# another process, and how long a cancel request waits for it (seconds)
+CANCEL_POLL_INTERVAL = 1.0
+CANCEL_WAIT_SECONDS = 30.0
+
+# Pending progress saves and the time of the last save, keyed by job ID
+_progress_saves: Dict[str, asyncio.Task] = {}
+_saved_at: Dict[str, float] = {}
+
+def upload_path(job_id: str) -> str:
+    """Get the path an upload is saved to before its job is processed"""
+    return os.path.join(settings.upload_dir, f".upload-{job_id}")
+
+def policy_file_path(content_hash: str) -> str:
+    """Get the content-addressed path of a stored policy file"""
+    return os.path.join(settings.upload_dir, f"{content_hash}.pdf")
+
+def _set(job: IngestionJob, **fields):
+    """Update job fields and its modification time"""
+    for name, value in fields.items():
+        setattr(job, name, value)
+    job.updated_at = datetime.now()
+
+async def _save(job: IngestionJob):
+    """Save a snapshot of a job"""
+    _saved_at[job.id] = time.monotonic()
+    await db.save_job(job.model_copy())
+
+async def _update(job: IngestionJob, **fields):
+    """Update job fields and its modification time, and save the job"""
+    _set(job, **fields)
+    # Let a pending progress save finish first so it cannot overwrite this one
+    pending = _progress_saves.get(job.id)
+    if pending is not None:
+        await asyncio.wait([pending])
+    await _save(job)
+
+async def _save_progress(job: IngestionJob):
+    try:
+        await _save(job)
+    except Exception as e:
+        print(f"Error saving progress of ingestion job {job.id}: {e}")
+    finally:
+        _progress_saves.pop(job.id, None)
+
+def _progress(job: IngestionJob, **fields):
+    """
+    Update job progress fields from a progress callback
+    
+    The job is saved in the background, at most every PROGRESS_SAVE_INTERVAL
+    seconds, so frequent callbacks do not each wait on a database write.
+    """
+    _set(job, **fields)
+    if job.id in _progress_saves or time.monotonic() - _saved_at.get(job.id, 0.0) < PROGRESS_SAVE_INTERVAL:
+        return
+    _progress_saves[job.id] = asyncio.create_task(_save_progress(job))
+
+def _remove_file(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+def _lock_path(name: str) -> str:
+    """Get the path of the lock file of an ingestion lock"""
+    digest = hashlib.sha256(name.encode()).hexdigest()
+    return os.path.join(settings.upload_dir, f".lock-{digest}")
+
+def _try_lock_file(path: str) -> Optional[int]:
+    """
+    Take an exclusive lock on a lock file without blocking
+    
+    Args:
+        path: Path of the lock file, created if missing
+    
+    Returns:
+        The descriptor of the locked file, or None if another holder has it
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    locked = False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # A holder removes the file before unlocking it, so a lock on a file
+        # that is no longer at the path does not count
+        locked = os.path.samestat(os.fstat(fd), os.stat(path))
+    except (BlockingIOError, FileNotFoundError):
+        pass
+    finally:
+        if not locked:
+            os.close(fd)
+    return fd if locked else None
+
+def _unlock_file(fd: int, path: str):
+    """Remove a lock file and release the lock held on it"""
+    try:
+        _remove_file(path)
+    finally:
+        os.close(fd)
+
+@asynccontextmanager
+async def ingestion_lock(name: str):
+    """
+    Hold an exclusive lock shared by all tasks and worker processes
+    
+    Tasks of this process queue on an asyncio lock; between processes the
+    lock is a file lock in the upload directory, retried every
+    LOCK_POLL_INTERVAL seconds.
+    
+    Args:
+        name: Name of the lock, such as a content hash
+    """
+    _lock_users[name] = _lock_users.get(name, 0) + 1
+    try:
+        async with _ingest_locks.setdefault(name, asyncio.Lock()):
+            path = _lock_path(name)
+            fd = _try_lock_file(path)
+            while fd is None:
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+                fd = _try_lock_file(path)
+            try:
+                yield
+            finally:
+                _unlock_file(fd, path)
+    finally:
+        _lock_users[name] -= 1
+        if not _lock_users[name]:
+            del _lock_users[name]
+            del _ingest_locks[name]
+
+def policy_lock(policy_id: str):
+    """
+    Get the ingestion lock of a policy record
+    
+    Held while a policy record is read and replaced or deleted, so
+    concurrent updates each release the version they actually replaced.
+    It is taken after the content lock, never before.
+    """
+    return ingestion_lock(f"policy:{policy_id}")
+
+def _worker_lock_path(worker_id: str) -> str:
+    """Get the path of the lock file a worker process holds while it runs"""
+    return _lock_path(f"worker:{worker_id}")
+
+def _worker_alive(worker_id: Optional[str]) -> bool:
+    """Whether a worker process is still running its job queue"""
+    if worker_id is None:
+        return False
+    path = _worker_lock_path(worker_id)
+    if not os.path.exists(path):
+        return False
+    fd = _try_lock_file(path)
+    if fd is None:
+        return True
+    # Left behind by a process that stopped without cleaning up
+    _unlock_file(fd, path)
+    return False
+
+async def recover_jobs():
+    """
+    Fail the jobs of worker processes that have stopped
+    
+    Such jobs would otherwise stay queued or running forever. Their uploads
+    are removed, and the contents an interrupted job was storing are
+    released unless a policy uses them.
+    """
+    for job in await db.unfinished_jobs():
+        if job.owner == WORKER_ID or _worker_alive(job.owner):
+            continue
+        
+        interrupted = job.status == "running"
+        _remove_file(upload_path(job.id))
+        await _update(job, status="failed", error="Interrupted by a server restart")
+        _saved_at.pop(job.id, None)
+        if interrupted:
+            try:
+                await release_document(job.content_hash)
+            except Exception as e:
+                print(f"Error releasing contents of interrupted ingestion job {job.id}: {e}")
+
+async def release_document(content_hash: str):
+    """
+    Delete the stored file and vectors of contents no policy uses any more
+    
+    Args:
+        content_hash: SHA-256 of the document file
+    """
+    generation_cache.invalidate(f"policy:{content_hash}")
+    async with ingestion_lock(content_hash):
+        # Keep the stored file and vectors while other policies share the same contents
+        if await db.policies_with_hash(content_hash):
+            return
+        await delete_document(content_hash)
+        _remove_file(policy_file_path(content_hash))
+
+async def _embed_chunks(job: IngestionJob, chunks: List[str]) -> List[List[float]]:
+    """
+    Embed a document's chunks
+    
+    For a policy update, chunks whose text is unchanged from the replaced
+    version reuse its stored vectors, and only the other chunks are embedded.
+    
+    Args:
+        job: The ingestion job
+        chunks: Text chunks of the document
+    
+    Returns:
+        The embedding of each chunk
+    """
+    previous = {}
+    if job.replaces is not None:
+        try:
+            previous = await get_document_vectors(job.replaces)
+        except Exception as e:
+            print(f"Error reading vectors of the replaced version {job.replaces}: {e}")
+    
+    digests = [chunk_digest(chunk) for chunk in chunks]
+    missing = [chunk for chunk, digest in zip(chunks, digests) if digest not in previous]
+    reused = len(chunks) - len(missing)
+    await _update(job, stage="embedding", chunks_total=len(chunks), chunks_reused=reused, chunks_embedded=reused)
+    
+    embedded = iter(await embed_documents(
+        missing,
+        lambda done, total: _progress(job, chunks_embedded=reused + done)
+    ))
+    return [previous[digest] if digest in previous else next(embedded) for digest in digests]
+
+async def run_ingestion(job: IngestionJob):
+    """
+    Process an uploaded policy document: extract, chunk, embed and store it
+    
+    If the same contents are already stored, the new policy record reuses
+    the existing vectors. On failure or cancellation, the uploaded file and
+    any vectors stored by this job are removed.
+    
+    A policy update (job.replaces set) stores the new version alongside the
+    old one, then switches the policy record to it in a single save, so
+    templates move to the new version atomically. The old version is
+    released once no policy uses it.
+    
+    Args:
+        job: The ingestion job to run
+    """
+    temp_path = upload_path(job.id)
+    file_path = policy_file_path(job.content_hash)
+    
+    # The job may have been cancelled while waiting to start
+    if job.status != "queued":
+        return
+    await _update(job, status="running")
+    
+    try:
+        # Serialize work on identical contents, across worker processes too, so
+        # they are processed once and cannot be released before the policy
+        # record that uses them is saved
+        async with ingestion_lock(job.content_hash):
+            created = False
+            try:
+                pages = []
+                existing = await get_document_by_hash(job.content_hash)
+                
+                if existing is not None and os.path.exists(file_path):
+                    # Identical contents are already embedded; reuse the vectors
+                    _remove_file(temp_path)
+                    pages = next((p.pages for p in await db.policies_with_hash(job.content_hash)), [])
+                else:
+                    os.replace(temp_path, file_path)
+                    created = True
+                    
+                    # Process the PDF
+                    await _update(job, stage="extracting")
+                    chunks, pages = await process_pdf(
+                        file_path,
+                        lambda done, total: _progress(job, pages_processed=done, pages_total=total)
+                    )
+                    
+                    if not chunks:
+                        raise ValueError("Failed to extract text from the PDF")
+                    
+                    # Generate embeddings
+                    embeddings = await _embed_chunks(job, chunks)
+                    
+                    # Store in vector database
+                    await _update(job, stage="storing", points_total=len(chunks))
+                    await store_embeddings(
+                        job.content_hash, job.policy_id, job.name, file_path, chunks, embeddings,
+                        lambda done, total: _progress(job, points_upserted=done)
+                    )
+                
+                async with policy_lock(job.policy_id):
+                    version = 1
+                    previous = await db.get_policy(job.policy_id) if job.replaces is not None else None
+                    if job.replaces is not None:
+                        if previous is None:
+                            raise ValueError("The policy was deleted while it was being updated")
+                        version = previous.version + (1 if previous.content_hash != job.content_hash else 0)
+                    
+                    # Create the policy record, or point the existing one at the new version
+                    policy = Policy(
+                        id=job.policy_id,
+                        name=job.name,
+                        description=job.description,
+                        uploaded_at=datetime.now(),
+                        content_hash=job.content_hash,
+                        pages=pages,
+                        version=version
+                    )
+                    
+                    # Store in database
+                    await db.save_policy(policy)
+            except BaseException:
+                await _clean_up(job, created)
+                raise
+        
+        # The current version may differ from job.replaces if another update
+        # finished first; it is released outside the content lock held above so
+        # two updates swapping contents cannot deadlock
+        if previous is not None and previous.content_hash != job.content_hash:
+            try:
+                await release_document(previous.content_hash)
+            except Exception as e:
+                print(f"Error releasing replaced version {previous.content_hash}: {e}")
+        
+        await _update(job, status="completed", stage="done", policy=policy)
+    except asyncio.CancelledError:
+        _remove_file(temp_path)
+        await _update(job, status="cancelled")
+        raise
+    except Exception as e:
+        _remove_file(temp_path)
+        await _update(job, status="failed", error=str(e))
+
+async def _clean_up(job: IngestionJob, created: bool):
+    """
+    Remove the upload and any vectors stored by an unfinished job
+    
+    Must be called while holding the ingestion lock of the job's contents.
+    
+    Args:
+        job: The ingestion job
+        created: Whether the job stored the file and vectors itself
+    """
+    _remove_file(upload_path(job.id))
+    if not created:
+        return
+    _remove_file(policy_file_path(job.content_hash))
+    try:
+        await delete_document(job.content_hash)
+    except Exception as e:
+        print(f"Error removing vectors of ingestion job {job.id}: {e}")
+
+async def _worker():
+    """Process queued ingestion jobs one at a time"""
+    while True:
+        job_id = await _queue.get()
+        try:
+            job = await db.get_job(job_id)
+            if job is None or job.status != "queued" or await db.job_cancel_requested(job_id):
+                continue
+            
+            task = asyncio.create_task(run_ingestion(job))
+            _running[job_id] = task
+            # Wait without propagating the job's own cancellation to the worker,
+            # cancelling the job if another process was asked to
+            while not task.done():
+                await asyncio.wait([task], timeout=CANCEL_POLL_INTERVAL)
+                if not task.done() and await db.job_cancel_requested(job_id):
+                    task.cancel()
+                    await asyncio.wait([task])
+        except Exception as e:
+            print(f"Error running ingestion job {job_id}: {e}")
+        finally:
+            _running.pop(job_id, None)
+            _saved_at.pop(job_id, None)
+            _queue.task_done()
+
+def _ensure_workers():
+    """Start the job queue and worker pool if they are not running"""
+    global _queue, _worker_lock
+    if _worker_lock is None:
+        _worker_lock = _try_lock_file(_worker_lock_path(WORKER_ID))
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=settings.ingestion.max_queued)
+    if not _workers:
+        _workers.extend(
+            asyncio.create_task(_worker())
+            for _ in range(max(1, settings.ingestion.workers))
+        )
+
+async def submit_job(job: IngestionJob):
+    """
+    Queue an ingestion job
+    
+    The upload must already be saved at upload_path(job.id).
+    
+    Args:
+        job: The job to queue
+    """
+    _ensure_workers()
+    if _queue.full():
+        raise QueueFullError("Too many policy documents are waiting to be processed")
+    job.owner = WORKER_ID
+    await db.save_job(job)
+    try:
+        _queue.put_nowait(job.id)
+    except asyncio.QueueFull:
+        # Another upload took the last place while this job was being saved
+        await _update(job, status="failed", error="Ingestion queue full")
+        raise QueueFullError("Too many policy documents are waiting to be processed")
+
+async def cancel_job(job: IngestionJob) -> bool:
+    """
+    Cancel a queued or running ingestion job
+    
+    A running job is cancelled and this waits until its partial results
+    have been cleaned up. Jobs run in the process that queued them, so the
+    request is also recorded in the database: a job running in another
+    worker is cancelled when that worker next checks, and this waits up to
+    CANCEL_WAIT_SECONDS for it to stop.
+    
+    Args:
+        job: The job to cancel
+    
+    Returns:
+        False if the job had already finished
+    """
+    if job.status not in ("queued", "running"):
+        return False
+    await db.request_job_cancel(job.id)
+    
+    if job.status == "queued":
+        _remove_file(upload_path(job.id))
+        await _update(job, status="cancelled")
+        return True
+    
+    task = _running.get(job.id)
+    if task is not None:
+        task.cancel()
+        await asyncio.wait([task])
+        return True
+    
+    deadline = time.monotonic() + CANCEL_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        await asyncio.sleep(CANCEL_POLL_INTERVAL)
+        current = await db.get_job(job.id)
+        if current is None or current.status != "running":
+            break
+    return True
+
+async def stop_workers():
+    """Cancel running jobs and stop the worker pool"""
+    global _queue, _worker_lock
+    for task in list(_running.values()):
+        task.cancel()
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_running.values(), *_workers, return_exceptions=True)
+    _workers.clear()
+    _queue = None
+    if _worker_lock is not None:
+        _unlock_file(_worker_lock, _worker_lock_path(WORKER_ID))
+        _worker_lock = None
@@ -0,0 +1,264 @@
+import time
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Tuple, Optional, Callable, Iterator, Sequence
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Upper bounds of the token count histogram buckets
+TOKEN_BUCKETS = (64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
+
+# Stage durations of the current request, in seconds, when a timing breakdown was requested
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Metric(ABC):
+    """
+    A named metric with one series per combination of label values
+    
+    Rendered in the Prometheus text exposition format.
+    """
+    type_name = "untyped"
+    
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+    
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+    
+    @abstractmethod
+    def _samples(self) -> List[Tuple[str, Sequence[Tuple[str, str]], float]]:
+        """Get (sample name, labels, value) for every series, called with the lock held"""
+    
+    def render(self) -> str:
+        """Render the metric's help, type and samples"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            samples = self._samples()
+        for name, labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A value that only increases"""
+    type_name = "counter"
+    
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        super().__init__(name, help_text, label_names)
+        # A metric without labels has a single series, reported from the start
+        self.values: Dict[Tuple[str, ...], float] = {} if self.label_names else {(): 0}
+    
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def _samples(self):
+        return [(self.name, list(zip(self.label_names, key)), value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """A value that can go up and down"""
+    type_name = "gauge"
+    
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+    
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+    
+    @contextmanager
+    def track(self, **labels: str) -> Iterator[None]:
+        """Count the enclosed block as in progress"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """Counts of observations in cumulative buckets, with their sum"""
+    type_name = "histogram"
+    
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # Per series: count in each bucket (not cumulative), sum of observations
+        self.series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+    
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self.series.setdefault(key, ([0] * len(self.buckets), [0.0]))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            total[0] += value
+    
+    def _samples(self):
+        samples = []
+        for key, (counts, total) in self.series.items():
+            labels = list(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels + [("le", _format_value(bound))], cumulative))
+            samples.append((f"{self.name}_sum", labels, total[0]))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    The metrics exposed on /metrics
+    
+    Collectors are called on every render and return metrics built from
+    state kept elsewhere, such as cache counters.
+    """
+    
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], List[Metric]]] = []
+    
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+    
+    def add_collector(self, collector: Callable[[], List[Metric]]):
+        self.collectors.append(collector)
+    
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        metrics = list(self.metrics)
+        for collector in self.collectors:
+            try:
+                metrics.extend(collector())
+            except Exception as e:
+                print(f"Error collecting metrics: {e}")
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.register(Histogram(
+    "stage_duration_seconds",
+    "Duration of generation, refinement and ingestion stages",
+    ["stage"]
+))
+http_request_seconds = registry.register(Histogram(
+    "http_request_duration_seconds",
+    "Duration of HTTP requests until the response starts",
+    ["method", "route"]
+))
+http_requests_in_flight = registry.register(Gauge(
+    "http_requests_in_flight",
+    "HTTP requests being handled"
+))
+llm_requests_in_flight = registry.register(Gauge(
+    "llm_requests_in_flight",
+    "Requests to the AI API in progress",
+    ["endpoint"]
+))
+llm_tokens = registry.register(Counter(
+    "llm_tokens_total",
+    "Tokens sent to and generated by the AI API",
+    ["kind"]
+))
+llm_request_tokens = registry.register(Histogram(
+    "llm_request_tokens",
+    "Prompt and completion tokens per chat completion",
+    ["kind"],
+    TOKEN_BUCKETS
+))
+llm_first_token_seconds = registry.register(Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time until the first token of a streamed chat completion"
+))
+
+def record_stage(stage: str, seconds: float):
+    """
+    Record the duration of a stage
+    
+    Args:
+        stage: The stage name
+        seconds: How long it took
+    """
+    stage_seconds.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Record the duration of the enclosed block as a stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+def record_tokens(prompt_tokens: int, completion_tokens: int):
+    """
+    Record the token counts of a chat completion
+    
+    Args:
+        prompt_tokens: Tokens in the request messages
+        completion_tokens: Tokens generated
+    """
+    llm_tokens.inc(prompt_tokens, kind="prompt")
+    llm_tokens.inc(completion_tokens, kind="completion")
+    llm_request_tokens.observe(prompt_tokens, kind="prompt")
+    llm_request_tokens.observe(completion_tokens, kind="completion")
+
+def start_request_timings() -> Dict[str, float]:
+    """
+    Collect the stage durations of the current request
+    
+    Returns:
+        The dict the durations are added to, in seconds by stage
+    """
+    timings: Dict[str, float] = {}
+    _request_timings.set(timings)
+    return timings
+
+def server_timing_header(timings: Dict[str, float], total: float) -> str:
+    """
+    Format stage durations as a Server-Timing header value
+    
+    Args:
+        timings: Durations in seconds by stage
+        total: Duration of the whole request in seconds
+    
+    Returns:
+        The header value, with durations in milliseconds
+    """
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
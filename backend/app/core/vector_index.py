@@ -0,0 +1,362 @@
+import os
+import json
+import uuid
+import fcntl
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple
+import numpy as np
+from qdrant_client.http import models
+
+VECTORS_FILE = "vectors.f32"
+INDEX_FILE = "index.json"
+LOCK_FILE = ".lock"
+
+def point_id(content_hash: str, chunk_index: int) -> str:
+    """Get the ID of a document chunk, the same as its Qdrant point ID"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{content_hash}:{chunk_index}"))
+
+class _Snapshot:
+    """An immutable view of the index: document ranges, payloads and the mapped matrix"""
+    
+    def __init__(
+        self,
+        documents: Dict[str, Dict[str, Any]],
+        dim: int,
+        mtime: Optional[int],
+        matrix: Optional[np.ndarray],
+        ids: Dict[str, Tuple[str, int]]
+    ):
+        self.documents = documents
+        self.dim = dim
+        self.mtime = mtime
+        self.matrix = matrix
+        # Point ID -> (content hash, chunk index)
+        self.ids = ids
+        # First row of each document, sorted, and the documents in that order
+        ordered = sorted(documents.items(), key=lambda item: item[1]["start"])
+        self.row_starts = np.array([document["start"] for _, document in ordered], dtype=np.int64)
+        self.row_hashes = [content_hash for content_hash, _ in ordered]
+    
+    def payload(self, content_hash: str, chunk_index: int) -> Dict[str, Any]:
+        document = self.documents[content_hash]
+        return {
+            "text": document["chunks"][chunk_index],
+            "policy_name": document["policy_name"],
+            "policy_hash": content_hash,
+            "chunk_index": chunk_index,
+        }
+
+class LocalVectorIndex:
+    """
+    In-process vector index for small corpora
+    
+    Normalized embeddings are kept in one float32 matrix file, memory-mapped
+    for reading, and every stored document owns a contiguous range of rows.
+    A search is a single matrix-vector product over the rows of the
+    requested documents followed by a top-k partition, so cosine scores
+    match the Qdrant collection.
+    
+    The row ranges and chunk payloads are kept in index.json. Writers take
+    an exclusive file lock, and every worker reloads the index when the
+    file changes, so several processes can share one directory.
+    
+    Reads use an immutable snapshot of the index. Writers build the next
+    snapshot on the side and swap it in when the files are written, so a
+    search never waits for a write in progress.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        # Guards swapping the snapshot; writers in this process also hold _write_mutex
+        self._lock = threading.Lock()
+        self._write_mutex = threading.Lock()
+        self._snapshot = _Snapshot({}, 0, None, None, {})
+        # Point IDs of each document's chunks; they do not depend on row ranges,
+        # so they are kept across snapshots instead of hashed again
+        self._chunk_ids: Dict[str, List[str]] = {}
+    
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+    
+    def _index_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self._file(INDEX_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+    
+    def _map(self, documents: Dict[str, Dict[str, Any]], dim: int) -> Optional[np.ndarray]:
+        """Memory-map the rows of the matrix file the documents use"""
+        rows = max((document["end"] for document in documents.values()), default=0)
+        if not rows or not dim:
+            return None
+        return np.memmap(self._file(VECTORS_FILE), dtype=np.float32, mode="r", shape=(rows, dim))
+    
+    def _snapshot_of(self, documents: Dict[str, Dict[str, Any]], dim: int, mtime: Optional[int] = None) -> _Snapshot:
+        """Build a snapshot of documents whose rows are in the matrix file"""
+        for content_hash in list(self._chunk_ids):
+            if content_hash not in documents:
+                del self._chunk_ids[content_hash]
+        ids = {}
+        for content_hash, document in documents.items():
+            count = document["end"] - document["start"]
+            chunk_ids = self._chunk_ids.get(content_hash)
+            if chunk_ids is None or len(chunk_ids) != count:
+                chunk_ids = self._chunk_ids[content_hash] = [point_id(content_hash, i) for i in range(count)]
+            ids.update((chunk_id, (content_hash, i)) for i, chunk_id in enumerate(chunk_ids))
+        return _Snapshot(documents, dim, mtime, self._map(documents, dim), ids)
+    
+    def _current(self) -> _Snapshot:
+        """Get the current snapshot, reloading it if another process changed the index"""
+        mtime = self._index_mtime()
+        snapshot = self._snapshot
+        if mtime == snapshot.mtime:
+            return snapshot
+        
+        with self._lock:
+            if self._snapshot.mtime != mtime:
+                documents: Dict[str, Dict[str, Any]] = {}
+                dim = 0
+                if mtime is not None:
+                    with open(self._file(INDEX_FILE)) as f:
+                        index = json.load(f)
+                    documents = index["documents"]
+                    dim = index["dim"]
+                self._snapshot = self._snapshot_of(documents, dim, mtime)
+            return self._snapshot
+    
+    @contextmanager
+    def _write_lock(self):
+        """
+        Hold an exclusive lock on the index across processes
+        
+        Yields:
+            The current snapshot, to base the write on
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with self._write_mutex, open(self._file(LOCK_FILE), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield self._current()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def _publish(self, documents: Dict[str, Dict[str, Any]], dim: int):
+        """Atomically write index.json and swap in the snapshot it describes"""
+        temp_path = self._file(INDEX_FILE + ".tmp")
+        with open(temp_path, "w") as f:
+            json.dump({"dim": dim, "documents": documents}, f)
+        snapshot = self._snapshot_of(documents, dim)
+        # Readers that see the new index.json wait for the swap instead of reloading it
+        with self._lock:
+            os.replace(temp_path, self._file(INDEX_FILE))
+            snapshot.mtime = self._index_mtime()
+            self._snapshot = snapshot
+    
+    def add_document(
+        self,
+        content_hash: str,
+        policy_id: str,
+        policy_name: str,
+        file_path: str,
+        chunks: List[str],
+        embeddings: List[List[float]]
+    ):
+        """
+        Store the chunks and embeddings of a document, replacing any earlier copy
+        
+        Args:
+            content_hash: SHA-256 of the document file
+            policy_id: The ID of the policy document that first uploaded it
+            policy_name: The name of the policy document
+            file_path: Path to the original document
+            chunks: List of text chunks from the document
+            embeddings: List of embedding vectors for each chunk
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(chunks), -1)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        
+        with self._write_lock() as snapshot:
+            # Copy the ranges, which removing rows shifts; readers keep the old snapshot
+            documents = {key: dict(document) for key, document in snapshot.documents.items()}
+            dim = snapshot.dim
+            if content_hash in documents:
+                self._remove_rows(documents, snapshot.matrix, content_hash)
+            if dim and vectors.shape[1] != dim:
+                raise ValueError(f"Expected {dim}-dimensional embeddings, got {vectors.shape[1]}")
+            
+            start = max((document["end"] for document in documents.values()), default=0)
+            with open(self._file(VECTORS_FILE), "ab") as f:
+                # Drop rows left behind by an interrupted write
+                f.truncate(start * vectors.shape[1] * 4)
+                f.write(vectors)
+            
+            documents[content_hash] = {
+                "start": start,
+                "end": start + len(chunks),
+                "policy_id": policy_id,
+                "policy_name": policy_name,
+                "file_path": file_path,
+                "chunks": chunks,
+            }
+            self._publish(documents, vectors.shape[1])
+    
+    def _remove_rows(self, documents: Dict[str, Dict[str, Any]], matrix: Optional[np.ndarray], content_hash: str):
+        """
+        Rewrite the matrix without a document's rows and shift later ranges
+        
+        The new matrix file replaces the old one, which stays mapped by
+        earlier snapshots until they are released.
+        
+        Args:
+            documents: Document ranges to update in place
+            matrix: The mapped matrix the ranges refer to
+            content_hash: SHA-256 of the document to remove
+        """
+        removed = documents.pop(content_hash)
+        start, end = removed["start"], removed["end"]
+        
+        if matrix is not None:
+            temp_path = self._file(VECTORS_FILE + ".tmp")
+            with open(temp_path, "wb") as f:
+                # Write the mapped rows directly; copying them to bytes first would hold the GIL
+                f.write(matrix[:start])
+                f.write(matrix[end:])
+            os.replace(temp_path, self._file(VECTORS_FILE))
+        
+        for document in documents.values():
+            if document["start"] >= end:
+                document["start"] -= end - start
+                document["end"] -= end - start
+    
+    def delete_document(self, content_hash: str):
+        """
+        Delete all chunks of a document
+        
+        Args:
+            content_hash: SHA-256 of the document file
+        """
+        with self._write_lock() as snapshot:
+            if content_hash in snapshot.documents:
+                documents = {key: dict(document) for key, document in snapshot.documents.items()}
+                self._remove_rows(documents, snapshot.matrix, content_hash)
+                self._publish(documents, snapshot.dim)
+    
+    def get_document(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the metadata of a stored document
+        
+        Args:
+            content_hash: SHA-256 of the document file
+        
+        Returns:
+            Document metadata or None if not found
+        """
+        document = self._current().documents.get(content_hash)
+        if document is None or document["end"] == document["start"]:
+            return None
+        return {
+            "policy_id": document["policy_id"],
+            "policy_name": document["policy_name"],
+            "policy_hash": content_hash,
+            "file_path": document["file_path"],
+        }
+    
+    def get_vectors(self, content_hash: str) -> List[Tuple[str, List[float]]]:
+        """
+        Get the chunk texts and (normalized) vectors of a stored document
+        
+        Args:
+            content_hash: SHA-256 of the document file
+        
+        Returns:
+            (text, vector) for each chunk, in chunk order
+        """
+        snapshot = self._current()
+        document = snapshot.documents.get(content_hash)
+        if document is None or snapshot.matrix is None:
+            return []
+        vectors = snapshot.matrix[document["start"]:document["end"]].tolist()
+        return list(zip(document["chunks"], vectors))
+    
+    def search(
+        self,
+        query_vector: List[float],
+        policy_hashes: Optional[List[str]],
+        limit: int,
+        with_vectors: bool = False
+    ) -> List[models.ScoredPoint]:
+        """
+        Find the chunks most similar to a query
+        
+        Args:
+            query_vector: Embedding of the query
+            policy_hashes: Content hashes of the documents to search, or None for all
+            limit: Maximum number of results
+            with_vectors: Whether to return the (normalized) vectors
+        
+        Returns:
+            Scored points, highest cosine similarity first
+        """
+        snapshot = self._current()
+        matrix = snapshot.matrix
+        if matrix is None or limit <= 0:
+            return []
+        
+        hashes = list(dict.fromkeys(policy_hashes)) if policy_hashes else list(snapshot.documents)
+        ranges = [
+            (content_hash, snapshot.documents[content_hash]["start"], snapshot.documents[content_hash]["end"])
+            for content_hash in hashes
+            if content_hash in snapshot.documents
+        ]
+        if not ranges:
+            return []
+        
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        
+        if policy_hashes:
+            # Score each document's row range in place, without copying rows
+            scores = np.concatenate([matrix[start:end] @ query for _, start, end in ranges])
+            rows = np.concatenate([np.arange(start, end) for _, start, end in ranges])
+        else:
+            scores = matrix @ query
+            rows = None
+        if not len(scores):
+            return []
+        
+        count = min(limit, len(scores))
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top])]
+        
+        results = []
+        for position in top:
+            row = int(rows[position]) if rows is not None else int(position)
+            owner = int(np.searchsorted(snapshot.row_starts, row, side="right")) - 1
+            content_hash = snapshot.row_hashes[owner]
+            chunk_index = row - snapshot.documents[content_hash]["start"]
+            results.append(models.ScoredPoint(
+                id=point_id(content_hash, chunk_index),
+                version=0,
+                score=float(scores[position]),
+                payload=snapshot.payload(content_hash, chunk_index),
+                vector=matrix[row].tolist() if with_vectors else None
+            ))
+        return results
+    
+    def retrieve(self, chunk_ids: List[str]) -> List[models.Record]:
+        """
+        Get stored chunks by ID
+        
+        Args:
+            chunk_ids: Point IDs of the chunks
+        
+        Returns:
+            Records of the chunks that exist
+        """
+        snapshot = self._current()
+        return [
+            models.Record(id=chunk_id, payload=snapshot.payload(*snapshot.ids[chunk_id]))
+            for chunk_id in chunk_ids
+            if chunk_id in snapshot.ids
+        ]
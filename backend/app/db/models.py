@@ -1,7 +1,6 @@
 from typing import List, Dict, Any, Optional
 from pydantic import BaseModel
 from datetime import datetime
-import uuid
 
 # Template models
 class InputField(BaseModel):
@@ -36,14 +35,45 @@ class PolicyCreate(PolicyBase):
     file_path: str
     content_hash: str
 
+class PageExtraction(BaseModel):
+    page: int
+    method: str  # "text" (embedded text layer) or "ocr"
+
 class Policy(PolicyBase):
     id: str
     uploaded_at: datetime
+    content_hash: str = ""  # SHA-256 of the uploaded file; keys its vectors
+    pages: List[PageExtraction] = []
+    version: int = 1  # Incremented each time a revised file replaces the policy's contents
+
+# Policy ingestion job models
+class IngestionJob(BaseModel):
+    id: str
+    policy_id: str
+    name: str
+    description: str = ""
+    content_hash: str
+    status: str = "queued"  # queued, running, completed, failed, cancelled
+    stage: str = "queued"  # queued, extracting, embedding, storing, done
+    pages_total: int = 0
+    pages_processed: int = 0
+    chunks_total: int = 0
+    chunks_embedded: int = 0
+    chunks_reused: int = 0  # Chunks whose vectors were reused from the replaced version
+    points_total: int = 0
+    points_upserted: int = 0
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    policy: Optional[Policy] = None
+    replaces: Optional[str] = None  # Content hash of the version a policy update replaces
+    owner: Optional[str] = None  # ID of the worker process whose queue holds the job
 
 # Document generation models
 class GenerateRequest(BaseModel):
     template_id: str
     inputs: Dict[str, str]
+    use_cache: bool = True  # Reuse the result of an identical earlier request
 
 class GenerateResponse(BaseModel):
     id: str
@@ -51,6 +81,19 @@ class GenerateResponse(BaseModel):
     generated_at: datetime
     template_id: str
 
+class BatchGenerateRequest(BaseModel):
+    template_id: str
+    inputs: List[Dict[str, str]]
+    use_cache: bool = True
+
+class BatchGenerateItem(BaseModel):
+    index: int  # Position of the inputs in the request
+    document: Optional[GenerateResponse] = None
+    error: Optional[str] = None
+
+class BatchGenerateResponse(BaseModel):
+    results: List[BatchGenerateItem]
+
 class RefineRequest(BaseModel):
     feedback: str
 
@@ -60,16 +103,22 @@ class RefineResponse(BaseModel):
     generated_at: datetime
     refined_at: datetime
     template_id: str
+    revision: int = 0  # Number of refinements applied to the document
+
+class RefinementTurn(BaseModel):
+    feedback: str
+    content: str  # The document after this refinement
+    refined_at: datetime
+    compacted: bool = False  # Summary of older turns; feedback lists their feedback
 
-# In-memory database for the POC
-class InMemoryDB:
-    def __init__(self):
-        self.templates: Dict[str, Template] = {}
-        self.policies: Dict[str, Policy] = {}
-        self.generated_documents: Dict[str, Dict[str, Any]] = {}
-        
-    def generate_id(self) -> str:
-        return str(uuid.uuid4())
-
-# Create a single instance of the database
-db = InMemoryDB() 
\ No newline at end of file
+# Stored generated document, with the request context and refinement session
+class GeneratedDocument(BaseModel):
+    id: str
+    content: str
+    generated_at: datetime
+    refined_at: Optional[datetime] = None
+    template_id: str
+    context: Dict[str, Any] = {}
+    original_content: Optional[str] = None  # First draft, set once the document is refined
+    turns: List[RefinementTurn] = []
+    revision: int = 0
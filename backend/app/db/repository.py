@@ -0,0 +1,494 @@
+import os
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Dict, Optional, Set, Type, TypeVar
+from pydantic import BaseModel
+from app.db.models import Template, Policy, GeneratedDocument, IngestionJob
+from app.core.config import settings
+
+Model = TypeVar("Model", bound=BaseModel)
+
+class Repository(ABC):
+    """
+    Storage interface for templates, policies, generated documents and ingestion jobs
+    
+    Routers only use these methods, so backends can be swapped from config.
+    Backends must implement every abstract method to be instantiated.
+    """
+    
+    def generate_id(self) -> str:
+        return str(uuid.uuid4())
+    
+    # Templates
+    @abstractmethod
+    async def get_template(self, template_id: str) -> Optional[Template]:
+        ...
+    
+    @abstractmethod
+    async def list_templates(self) -> List[Template]:
+        ...
+    
+    @abstractmethod
+    async def save_template(self, template: Template):
+        ...
+    
+    @abstractmethod
+    async def delete_template(self, template_id: str) -> bool:
+        ...
+    
+    @abstractmethod
+    async def templates_using_policy(self, policy_id: str) -> List[str]:
+        """Get the IDs of the templates associated with a policy"""
+    
+    # Policies
+    @abstractmethod
+    async def get_policy(self, policy_id: str) -> Optional[Policy]:
+        ...
+    
+    @abstractmethod
+    async def get_policies(self, policy_ids: List[str]) -> List[Policy]:
+        """Get the policies with the given IDs, skipping missing ones"""
+    
+    @abstractmethod
+    async def list_policies(self) -> List[Policy]:
+        ...
+    
+    @abstractmethod
+    async def policies_with_hash(self, content_hash: str) -> List[Policy]:
+        """Get the policies whose file has the given content hash"""
+    
+    @abstractmethod
+    async def save_policy(self, policy: Policy):
+        ...
+    
+    @abstractmethod
+    async def delete_policy(self, policy_id: str) -> bool:
+        ...
+    
+    # Generated documents
+    @abstractmethod
+    async def get_document(self, document_id: str) -> Optional[GeneratedDocument]:
+        """Get a generated document, or None if it is missing or expired"""
+    
+    @abstractmethod
+    async def save_document(self, document: GeneratedDocument):
+        ...
+    
+    # Ingestion jobs
+    @abstractmethod
+    async def get_job(self, job_id: str) -> Optional[IngestionJob]:
+        ...
+    
+    @abstractmethod
+    async def save_job(self, job: IngestionJob):
+        ...
+    
+    @abstractmethod
+    async def unfinished_jobs(self) -> List[IngestionJob]:
+        """Get the jobs that are queued or running"""
+    
+    @abstractmethod
+    async def request_job_cancel(self, job_id: str):
+        """Record that a job should be cancelled by the worker running it"""
+    
+    @abstractmethod
+    async def job_cancel_requested(self, job_id: str) -> bool:
+        ...
+    
+    def close(self):
+        pass
+
+
+class InMemoryRepository(Repository):
+    """
+    Per-process store in plain dicts; state is lost on restart
+    
+    Generated documents are kept in an LRU bounded by count and expire after
+    a time-to-live. Documents evicted over the limit are moved to the spill
+    store if one is given, and dropped otherwise.
+    """
+    
+    def __init__(
+        self,
+        document_max_entries: int,
+        document_ttl_seconds: float,
+        spill: Optional[Repository] = None
+    ):
+        self.templates: Dict[str, Template] = {}
+        self.policies: Dict[str, Policy] = {}
+        # Document ID -> (expiry time, document), least recently used first
+        self.generated_documents: OrderedDict = OrderedDict()
+        self.ingestion_jobs: Dict[str, IngestionJob] = {}
+        self.cancelled_jobs: Set[str] = set()
+        self.document_max_entries = document_max_entries
+        self.document_ttl_seconds = document_ttl_seconds
+        self.spill = spill
+    
+    async def get_template(self, template_id: str) -> Optional[Template]:
+        return self.templates.get(template_id)
+    
+    async def list_templates(self) -> List[Template]:
+        return list(self.templates.values())
+    
+    async def save_template(self, template: Template):
+        self.templates[template.id] = template
+    
+    async def delete_template(self, template_id: str) -> bool:
+        return self.templates.pop(template_id, None) is not None
+    
+    async def templates_using_policy(self, policy_id: str) -> List[str]:
+        return [t.id for t in self.templates.values() if policy_id in t.associated_policies]
+    
+    async def get_policy(self, policy_id: str) -> Optional[Policy]:
+        return self.policies.get(policy_id)
+    
+    async def get_policies(self, policy_ids: List[str]) -> List[Policy]:
+        return [self.policies[policy_id] for policy_id in policy_ids if policy_id in self.policies]
+    
+    async def list_policies(self) -> List[Policy]:
+        return list(self.policies.values())
+    
+    async def policies_with_hash(self, content_hash: str) -> List[Policy]:
+        return [p for p in self.policies.values() if p.content_hash == content_hash]
+    
+    async def save_policy(self, policy: Policy):
+        self.policies[policy.id] = policy
+    
+    async def delete_policy(self, policy_id: str) -> bool:
+        return self.policies.pop(policy_id, None) is not None
+    
+    async def get_document(self, document_id: str) -> Optional[GeneratedDocument]:
+        entry = self.generated_documents.get(document_id)
+        if entry is not None and entry[0] < time.monotonic():
+            del self.generated_documents[document_id]
+            entry = None
+        
+        if entry is not None:
+            self.generated_documents.move_to_end(document_id)
+            self.generated_documents[document_id] = (time.monotonic() + self.document_ttl_seconds, entry[1])
+            return entry[1]
+        
+        # Bring a spilled document back into memory
+        document = await self.spill.get_document(document_id) if self.spill is not None else None
+        if document is not None:
+            await self.save_document(document)
+        return document
+    
+    async def save_document(self, document: GeneratedDocument):
+        self.generated_documents.pop(document.id, None)
+        self.generated_documents[document.id] = (time.monotonic() + self.document_ttl_seconds, document)
+        
+        while len(self.generated_documents) > max(self.document_max_entries, 0):
+            _, (expires_at, evicted) = self.generated_documents.popitem(last=False)
+            if self.spill is not None and expires_at >= time.monotonic():
+                await self.spill.save_document(evicted)
+    
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+    
+    async def get_job(self, job_id: str) -> Optional[IngestionJob]:
+        return self.ingestion_jobs.get(job_id)
+    
+    async def save_job(self, job: IngestionJob):
+        self.ingestion_jobs[job.id] = job
+    
+    async def unfinished_jobs(self) -> List[IngestionJob]:
+        return [job for job in self.ingestion_jobs.values() if job.status in ("queued", "running")]
+    
+    async def request_job_cancel(self, job_id: str):
+        self.cancelled_jobs.add(job_id)
+    
+    async def job_cancel_requested(self, job_id: str) -> bool:
+        return job_id in self.cancelled_jobs
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS templates (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS template_policies (
+    template_id TEXT NOT NULL,
+    policy_id TEXT NOT NULL,
+    PRIMARY KEY (template_id, policy_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_template_policies_policy ON template_policies (policy_id);
+CREATE TABLE IF NOT EXISTS policies (
+    id TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_policies_content_hash ON policies (content_hash);
+CREATE TABLE IF NOT EXISTS generated_documents (
+    id TEXT PRIMARY KEY,
+    template_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_generated_documents_template ON generated_documents (template_id);
+CREATE INDEX IF NOT EXISTS idx_generated_documents_accessed ON generated_documents (accessed_at);
+CREATE TABLE IF NOT EXISTS ingestion_jobs (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ingestion_job_cancels (
+    job_id TEXT PRIMARY KEY
+) WITHOUT ROWID;
+"""
+
+class SQLiteRepository(Repository):
+    """
+    Durable store in a local SQLite database in WAL mode
+    
+    Records are stored as JSON alongside indexed lookup columns. Every
+    uvicorn worker of one host sees the same state. WAL mode is not safe
+    across hosts, so the database must not be shared by several replicas.
+    Generated documents not read or refined for document_ttl_seconds are
+    deleted as new documents are saved.
+    """
+    
+    def __init__(self, path: str, document_ttl_seconds: float):
+        self.path = path
+        self.document_ttl_seconds = document_ttl_seconds
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Open the database and create the schema on first use"""
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self._connection = connection
+        return self._connection
+    
+    def _get(self, table: str, model: Type[Model], record_id: str) -> Optional[Model]:
+        with self._lock:
+            row = self._connect().execute(f"SELECT data FROM {table} WHERE id = ?", (record_id,)).fetchone()
+        return model.model_validate_json(row[0]) if row else None
+    
+    def _list(self, table: str, model: Type[Model], where: str = "", params: tuple = ()) -> List[Model]:
+        with self._lock:
+            rows = self._connect().execute(f"SELECT data FROM {table} {where} ORDER BY rowid", params).fetchall()
+        return [model.model_validate_json(row[0]) for row in rows]
+    
+    def _delete(self, table: str, record_id: str) -> bool:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                return connection.execute(f"DELETE FROM {table} WHERE id = ?", (record_id,)).rowcount > 0
+    
+    def _get_template(self, template_id: str) -> Optional[Template]:
+        return self._get("templates", Template, template_id)
+    
+    def _list_templates(self) -> List[Template]:
+        return self._list("templates", Template)
+    
+    def _save_template(self, template: Template):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "INSERT INTO templates (id, data) VALUES (?, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET data = excluded.data",
+                    (template.id, template.model_dump_json())
+                )
+                connection.execute("DELETE FROM template_policies WHERE template_id = ?", (template.id,))
+                connection.executemany(
+                    "INSERT OR IGNORE INTO template_policies (template_id, policy_id) VALUES (?, ?)",
+                    [(template.id, policy_id) for policy_id in template.associated_policies]
+                )
+    
+    def _delete_template(self, template_id: str) -> bool:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("DELETE FROM template_policies WHERE template_id = ?", (template_id,))
+                return connection.execute("DELETE FROM templates WHERE id = ?", (template_id,)).rowcount > 0
+    
+    def _templates_using_policy(self, policy_id: str) -> List[str]:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT template_id FROM template_policies WHERE policy_id = ?", (policy_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+    
+    def _get_policy(self, policy_id: str) -> Optional[Policy]:
+        return self._get("policies", Policy, policy_id)
+    
+    def _get_policies(self, policy_ids: List[str]) -> List[Policy]:
+        if not policy_ids:
+            return []
+        found = {
+            policy.id: policy
+            for policy in self._list(
+                "policies", Policy,
+                f"WHERE id IN ({','.join('?' * len(policy_ids))})", tuple(policy_ids)
+            )
+        }
+        return [found[policy_id] for policy_id in policy_ids if policy_id in found]
+    
+    def _list_policies(self) -> List[Policy]:
+        return self._list("policies", Policy)
+    
+    def _policies_with_hash(self, content_hash: str) -> List[Policy]:
+        return self._list("policies", Policy, "WHERE content_hash = ?", (content_hash,))
+    
+    def _save_policy(self, policy: Policy):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "INSERT INTO policies (id, content_hash, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET content_hash = excluded.content_hash, data = excluded.data",
+                    (policy.id, policy.content_hash, policy.model_dump_json())
+                )
+    
+    def _delete_policy(self, policy_id: str) -> bool:
+        return self._delete("policies", policy_id)
+    
+    def _get_document(self, document_id: str) -> Optional[GeneratedDocument]:
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                row = connection.execute(
+                    "SELECT data FROM generated_documents WHERE id = ? AND accessed_at >= ?",
+                    (document_id, now - self.document_ttl_seconds)
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE generated_documents SET accessed_at = ? WHERE id = ?", (now, document_id)
+                    )
+        return GeneratedDocument.model_validate_json(row[0]) if row else None
+    
+    def _save_document(self, document: GeneratedDocument):
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "INSERT INTO generated_documents (id, template_id, data, accessed_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET template_id = excluded.template_id, "
+                    "data = excluded.data, accessed_at = excluded.accessed_at",
+                    (document.id, document.template_id, document.model_dump_json(), now)
+                )
+                connection.execute(
+                    "DELETE FROM generated_documents WHERE accessed_at < ?", (now - self.document_ttl_seconds,)
+                )
+    
+    def _get_job(self, job_id: str) -> Optional[IngestionJob]:
+        return self._get("ingestion_jobs", IngestionJob, job_id)
+    
+    def _save_job(self, job: IngestionJob):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "INSERT INTO ingestion_jobs (id, data) VALUES (?, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET data = excluded.data",
+                    (job.id, job.model_dump_json())
+                )
+    
+    def _unfinished_jobs(self) -> List[IngestionJob]:
+        return self._list(
+            "ingestion_jobs", IngestionJob, "WHERE json_extract(data, '$.status') IN ('queued', 'running')"
+        )
+    
+    def _request_job_cancel(self, job_id: str):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("INSERT OR IGNORE INTO ingestion_job_cancels (job_id) VALUES (?)", (job_id,))
+    
+    def _job_cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT 1 FROM ingestion_job_cancels WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return row is not None
+    
+    # SQLite calls block, so each runs in a worker thread to keep the event loop free
+    async def get_template(self, template_id: str) -> Optional[Template]:
+        return await asyncio.to_thread(self._get_template, template_id)
+    
+    async def list_templates(self) -> List[Template]:
+        return await asyncio.to_thread(self._list_templates)
+    
+    async def save_template(self, template: Template):
+        await asyncio.to_thread(self._save_template, template)
+    
+    async def delete_template(self, template_id: str) -> bool:
+        return await asyncio.to_thread(self._delete_template, template_id)
+    
+    async def templates_using_policy(self, policy_id: str) -> List[str]:
+        return await asyncio.to_thread(self._templates_using_policy, policy_id)
+    
+    async def get_policy(self, policy_id: str) -> Optional[Policy]:
+        return await asyncio.to_thread(self._get_policy, policy_id)
+    
+    async def get_policies(self, policy_ids: List[str]) -> List[Policy]:
+        return await asyncio.to_thread(self._get_policies, policy_ids)
+    
+    async def list_policies(self) -> List[Policy]:
+        return await asyncio.to_thread(self._list_policies)
+    
+    async def policies_with_hash(self, content_hash: str) -> List[Policy]:
+        return await asyncio.to_thread(self._policies_with_hash, content_hash)
+    
+    async def save_policy(self, policy: Policy):
+        await asyncio.to_thread(self._save_policy, policy)
+    
+    async def delete_policy(self, policy_id: str) -> bool:
+        return await asyncio.to_thread(self._delete_policy, policy_id)
+    
+    async def get_document(self, document_id: str) -> Optional[GeneratedDocument]:
+        return await asyncio.to_thread(self._get_document, document_id)
+    
+    async def save_document(self, document: GeneratedDocument):
+        await asyncio.to_thread(self._save_document, document)
+    
+    async def get_job(self, job_id: str) -> Optional[IngestionJob]:
+        return await asyncio.to_thread(self._get_job, job_id)
+    
+    async def save_job(self, job: IngestionJob):
+        await asyncio.to_thread(self._save_job, job)
+    
+    async def unfinished_jobs(self) -> List[IngestionJob]:
+        return await asyncio.to_thread(self._unfinished_jobs)
+    
+    async def request_job_cancel(self, job_id: str):
+        await asyncio.to_thread(self._request_job_cancel, job_id)
+    
+    async def job_cancel_requested(self, job_id: str) -> bool:
+        return await asyncio.to_thread(self._job_cancel_requested, job_id)
+    
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def create_repository() -> Repository:
+    """Create the storage backend selected by settings.storage.backend"""
+    storage = settings.storage
+    if storage.backend == "memory":
+        spill = None
+        if storage.document_spill_path:
+            spill = SQLiteRepository(storage.document_spill_path, storage.document_ttl_seconds)
+        return InMemoryRepository(storage.document_max_entries, storage.document_ttl_seconds, spill)
+    if storage.backend == "sqlite":
+        return SQLiteRepository(storage.path, storage.document_ttl_seconds)
+    raise ValueError(f"Unknown storage backend: {storage.backend}")
+
+# Create a single instance of the database
+db = create_repository()
@@ -1,17 +1,88 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
+from typing import Optional
 import os
+import time
+import asyncio
 
 from app.api.templates import router as templates_router
 from app.api.policies import router as policies_router
 from app.api.generation import router as generation_router
 from app.core.config import settings
+from app.core.ai import close_client, prompt_stats
+from app.core.cache import (
+    embedding_cache, generation_cache, chunk_cache, embedding_flight, completion_flight, generation_flight
+)
+from app.core.database import init_collection, close_qdrant_client
+from app.core.metrics import (
+    registry, Counter, Gauge, http_request_seconds, http_requests_in_flight,
+    start_request_timings, server_timing_header
+)
+from app.core.ingestion import recover_jobs, stop_workers
+from app.utils.pdf import shutdown_ocr_executor
+from app.db.repository import db
+
+# Set once the vector database is initialized; reported by the readiness probe
+_ready = False
+_init_task: Optional[asyncio.Task] = None
+
+async def init_vector_db():
+    """
+    Initialize the vector database, retrying with exponential backoff
+    
+    Runs in the background so the API starts serving immediately; the
+    readiness endpoint reports 503 until this succeeds. Ingestion jobs
+    left unfinished by stopped workers are then failed, since releasing
+    what they stored needs the vector database.
+    """
+    global _ready
+    delay = settings.startup.init_backoff
+    attempt = 0
+    while True:
+        attempt += 1
+        if await init_collection():
+            try:
+                await recover_jobs()
+            except Exception as e:
+                print(f"Error recovering unfinished ingestion jobs: {e}")
+            _ready = True
+            return
+        if settings.startup.init_max_attempts and attempt >= settings.startup.init_max_attempts:
+            print(f"Error initializing vector database: giving up after {attempt} attempts")
+            return
+        print(f"Vector database not ready (attempt {attempt}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, settings.startup.init_max_backoff)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start background initialization, and release shared clients on shutdown
+    """
+    global _init_task
+    os.makedirs(settings.upload_dir, exist_ok=True)
+    _init_task = asyncio.create_task(init_vector_db())
+    
+    yield
+    
+    _init_task.cancel()
+    # Let a pending init_collection finish cancelling before its client is closed
+    await asyncio.gather(_init_task, return_exceptions=True)
+    await stop_workers()
+    await close_client()
+    await close_qdrant_client()
+    shutdown_ocr_executor()
+    embedding_cache.close()
+    db.close()
 
 app = FastAPI(
     title="Prompt Template System API",
     description="API for the Prompt Template System",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
 # Configure CORS
@@ -23,6 +94,51 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """
+    Record request latency and in-flight requests, and add the stage
+    timings of the request as a Server-Timing header if enabled
+    """
+    timings = start_request_timings() if settings.metrics.timing_header else None
+    start = time.perf_counter()
+    with http_requests_in_flight.track():
+        response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    
+    route = request.scope.get("route")
+    http_request_seconds.observe(elapsed, method=request.method, route=getattr(route, "path", "unmatched"))
+    if timings is not None:
+        response.headers["Server-Timing"] = server_timing_header(timings, elapsed)
+    return response
+
+def cache_metrics():
+    """Report the counters of the shared caches"""
+    hits = Counter("cache_hits_total", "Cache lookups that found an entry", ["cache"])
+    misses = Counter("cache_misses_total", "Cache lookups that found no entry", ["cache"])
+    hit_ratio = Gauge("cache_hit_ratio", "Share of cache lookups that found an entry", ["cache"])
+    for name, cache in [("embedding", embedding_cache), ("generation", generation_cache), ("chunk", chunk_cache)]:
+        stats = cache.stats()
+        hits.inc(stats["hits"], cache=name)
+        misses.inc(stats["misses"], cache=name)
+        hit_ratio.set(stats["hit_rate"], cache=name)
+    return [hits, misses, hit_ratio]
+
+def flight_metrics():
+    """Report the calls made and saved by request coalescing"""
+    calls = Counter("coalescing_calls_total", "Calls made after coalescing identical concurrent requests", ["flight"])
+    coalesced = Counter("coalescing_saved_calls_total", "Requests that joined an identical call in flight", ["flight"])
+    in_flight = Gauge("coalescing_in_flight", "Distinct calls in flight", ["flight"])
+    for name, flight in [("embedding", embedding_flight), ("completion", completion_flight), ("generation", generation_flight)]:
+        stats = flight.stats()
+        calls.inc(stats["calls"], flight=name)
+        coalesced.inc(stats["coalesced"], flight=name)
+        in_flight.set(stats["in_flight"], flight=name)
+    return [calls, coalesced, in_flight]
+
+registry.add_collector(cache_metrics)
+registry.add_collector(flight_metrics)
+
 # Include routers
 app.include_router(templates_router, prefix="/api/v1", tags=["templates"])
 app.include_router(policies_router, prefix="/api/v1", tags=["policies"])
@@ -38,4 +154,37 @@ async def health_check():
     """
     Health check endpoint
     """
-    return {"status": "ok"} 
\ No newline at end of file
+    return {"status": "ok"}
+
+@app.get("/api/ready", tags=["health"])
+async def readiness_check():
+    """
+    Readiness check endpoint: 503 until the vector database is initialized
+    """
+    if not _ready:
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return {"status": "ready"}
+
+@app.get("/metrics", tags=["health"], response_class=PlainTextResponse)
+async def metrics():
+    """
+    Metrics in the Prometheus text exposition format
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/stats", tags=["health"])
+async def cache_stats():
+    """
+    Cache hit/miss, request coalescing and prompt token statistics
+    """
+    return {
+        "embedding_cache": embedding_cache.stats(),
+        "generation_cache": generation_cache.stats(),
+        "chunk_cache": chunk_cache.stats(),
+        "coalescing": {
+            "embedding": embedding_flight.stats(),
+            "completion": completion_flight.stats(),
+            "generation": generation_flight.stats(),
+        },
+        "prompts": prompt_stats.stats(),
+    } 
\ No newline at end of file
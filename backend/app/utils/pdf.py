@@ -1,34 +1,209 @@
 import os
-import tempfile
-from typing import List
-import pdf2image
-import pytesseract
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import time
+import asyncio
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple, Callable
 from app.core.config import settings
+from app.db.models import PageExtraction
+from app.core.metrics import timed, record_stage
 
-async def extract_text_from_pdf(file_path: str) -> str:
+# pdf2image, pytesseract and langchain are slow to import and only needed for
+# ingestion, so they are imported inside the functions that use them
+
+# Process pool for OCR, created on first use
+_ocr_executor: Optional[ProcessPoolExecutor] = None
+
+def ocr_worker_count() -> int:
+    """
+    Get the number of OCR worker processes
+    
+    Returns:
+        The configured worker count, or the number of cores available to this process
+    """
+    if settings.ocr.workers > 0:
+        return settings.ocr.workers
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _init_ocr_worker():
+    """Initialize an OCR worker process"""
+    # Pages are already processed in parallel, so keep Tesseract single-threaded
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+def get_ocr_executor() -> ProcessPoolExecutor:
     """
-    Extract text from PDF file using OCR
+    Get the shared OCR process pool
+    
+    Returns:
+        The process pool executor
+    """
+    global _ocr_executor
+    if _ocr_executor is None:
+        # Spawn rather than fork: the server process has event-loop, thread
+        # pool and cache locks that a forked child could inherit held
+        _ocr_executor = ProcessPoolExecutor(
+            max_workers=ocr_worker_count(),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_ocr_worker
+        )
+    return _ocr_executor
+
+def shutdown_ocr_executor():
+    """Shut down the OCR process pool if it was started"""
+    global _ocr_executor
+    if _ocr_executor is not None:
+        _ocr_executor.shutdown(cancel_futures=True)
+        _ocr_executor = None
+
+def _extract_text_layer(file_path: str, first_page: int, last_page: int) -> List[str]:
+    """
+    Extract the embedded text layer of a range of pages with pdftotext
     
     Args:
         file_path: Path to the PDF file
+        first_page: First page number (1-based, inclusive)
+        last_page: Last page number (inclusive)
+    
+    Returns:
+        Text of each page in the range; empty strings if extraction failed
+    """
+    page_count = last_page - first_page + 1
+    try:
+        result = subprocess.run(
+            ["pdftotext", "-f", str(first_page), "-l", str(last_page), "-enc", "UTF-8", file_path, "-"],
+            capture_output=True,
+            check=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Error reading text layer of pages {first_page}-{last_page}: {e}")
+        return [""] * page_count
+    
+    # pdftotext terminates every page with a form feed
+    pages = result.stdout.decode("utf-8", errors="replace").split("\f")[:page_count]
+    return pages + [""] * (page_count - len(pages))
+
+def _has_usable_text(text: str) -> bool:
+    """Check whether a page's text layer has enough content to skip OCR"""
+    return len("".join(text.split())) >= settings.ocr.min_text_chars
+
+def _ocr_page(file_path: str, page: int) -> str:
+    """
+    Rasterize and OCR a single page
+    
+    Args:
+        file_path: Path to the PDF file
+        page: Page number (1-based)
+    
+    Returns:
+        OCR text of the page
+    """
+    import pdf2image
+    import pytesseract
+    
+    images = pdf2image.convert_from_path(
+        file_path,
+        dpi=settings.ocr.dpi,
+        first_page=page,
+        last_page=page
+    )
+    return "".join(pytesseract.image_to_string(img) for img in images)
+
+def _extract_page_range(file_path: str, first_page: int, last_page: int) -> List[Tuple[str, str, float]]:
+    """
+    Extract the text of a range of pages (runs in a worker process)
+    
+    Each page uses its embedded text layer when it has usable text and
+    falls back to OCR otherwise (e.g. scanned or image-only pages).
+    
+    Args:
+        file_path: Path to the PDF file
+        first_page: First page number (1-based, inclusive)
+        last_page: Last page number (inclusive)
+    
+    Returns:
+        (text, method, seconds spent on OCR) for each page in the range, in page order
+    """
+    if settings.ocr.use_text_layer:
+        texts = _extract_text_layer(file_path, first_page, last_page)
+    else:
+        texts = [""] * (last_page - first_page + 1)
+    
+    results = []
+    for page, text in enumerate(texts, start=first_page):
+        if _has_usable_text(text):
+            results.append((text, "text", 0.0))
+        else:
+            start = time.perf_counter()
+            text = _ocr_page(file_path, page)
+            results.append((text, "ocr", time.perf_counter() - start))
+    return results
+
+async def extract_text_from_pdf(
+    file_path: str,
+    progress: Optional[Callable[[int, int], None]] = None
+) -> Tuple[str, List[PageExtraction]]:
+    """
+    Extract text from PDF file, using OCR for pages without a text layer
+    
+    Pages are processed in small windows inside worker processes, so only
+    a bounded number of page images are held in memory at any time.
+    
+    Args:
+        file_path: Path to the PDF file
+        progress: Optional callback called with (pages processed, total pages)
         
     Returns:
-        Extracted text as a string
+        Extracted text as a string and the extraction method used for each page
     """
+    import pdf2image
+    
     try:
-        # Convert PDF to images
-        images = pdf2image.convert_from_path(file_path)
+        info = await asyncio.to_thread(pdf2image.pdfinfo_from_path, file_path)
+        page_count = info["Pages"]
+        window = max(1, settings.ocr.window_pages)
+        
+        loop = asyncio.get_running_loop()
+        executor = get_ocr_executor()
+        # Limit windows in flight to the number of workers
+        semaphore = asyncio.Semaphore(ocr_worker_count())
+        pages_processed = 0
+        if progress:
+            progress(pages_processed, page_count)
+        
+        async def extract_window(first_page: int) -> List[Tuple[str, str, float]]:
+            nonlocal pages_processed
+            last_page = min(first_page + window - 1, page_count)
+            async with semaphore:
+                results = await loop.run_in_executor(
+                    executor, _extract_page_range, file_path, first_page, last_page
+                )
+            # OCR runs in worker processes, so its timings are recorded here
+            for _, method, seconds in results:
+                if method == "ocr":
+                    record_stage("ocr_page", seconds)
+            pages_processed += len(results)
+            if progress:
+                progress(pages_processed, page_count)
+            return results
         
-        # Extract text from each image using OCR
-        text = ""
-        for img in images:
-            text += pytesseract.image_to_string(img) + "\n\n"
-            
-        return text
+        windows = await asyncio.gather(*[
+            extract_window(first_page) for first_page in range(1, page_count + 1, window)
+        ])
+        
+        page_results = [result for window_results in windows for result in window_results]
+        text = "".join(page_text + "\n\n" for page_text, _, _ in page_results)
+        pages = [
+            PageExtraction(page=page, method=method)
+            for page, (_, method, _) in enumerate(page_results, start=1)
+        ]
+        return text, pages
     except Exception as e:
         print(f"Error extracting text from PDF: {e}")
-        return ""
+        return "", []
 
 async def split_text(text: str) -> List[str]:
     """
@@ -40,25 +215,32 @@ async def split_text(text: str) -> List[str]:
     Returns:
         List of text chunks
     """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=settings.rag.chunk_size,
         chunk_overlap=settings.rag.chunk_overlap,
         length_function=len,
     )
     
-    chunks = text_splitter.split_text(text)
+    with timed("chunking"):
+        chunks = text_splitter.split_text(text)
     return chunks
 
-async def process_pdf(file_path: str) -> List[str]:
+async def process_pdf(
+    file_path: str,
+    progress: Optional[Callable[[int, int], None]] = None
+) -> Tuple[List[str], List[PageExtraction]]:
     """
     Process a PDF file: extract text and split into chunks
     
     Args:
         file_path: Path to the PDF file
+        progress: Optional callback called with (pages processed, total pages)
         
     Returns:
-        List of text chunks
+        List of text chunks and the extraction method used for each page
     """
-    text = await extract_text_from_pdf(file_path)
+    text, pages = await extract_text_from_pdf(file_path, progress)
     chunks = await split_text(text)
-    return chunks 
\ No newline at end of file
+    return chunks, pages 
\ No newline at end of file
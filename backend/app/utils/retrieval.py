@@ -0,0 +1,125 @@
+from typing import List, Dict, Any
+import numpy as np
+
+# Shortest overlap between adjacent chunks that is trusted to be shared text
+MIN_OVERLAP_CHARS = 20
+
+def mmr_select(
+    query_vector: List[float],
+    candidate_vectors: List[List[float]],
+    count: int,
+    diversity: float
+) -> List[int]:
+    """
+    Select candidates by maximal marginal relevance
+    
+    Each step picks the candidate with the best trade-off between similarity
+    to the query and dissimilarity to the candidates already picked.
+    
+    Args:
+        query_vector: Embedding of the query
+        candidate_vectors: Embeddings of the candidates
+        count: Number of candidates to select
+        diversity: Weight of dissimilarity, from 0 (pure relevance) to 1
+    
+    Returns:
+        Indexes of the selected candidates, in selection order
+    """
+    if not candidate_vectors or count <= 0:
+        return []
+    
+    candidates = np.asarray(candidate_vectors, dtype=np.float32)
+    query = np.asarray(query_vector, dtype=np.float32)
+    candidates /= np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+    
+    relevance = candidates @ query
+    # Highest similarity of each candidate to any selected one
+    redundancy = np.full(len(candidates), -np.inf, dtype=np.float32)
+    selected: List[int] = []
+    available = np.ones(len(candidates), dtype=bool)
+    
+    for _ in range(min(count, len(candidates))):
+        if selected:
+            scores = (1 - diversity) * relevance - diversity * redundancy
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, candidates @ candidates[best])
+    
+    return selected
+
+def merge_overlapping_text(first: str, second: str, max_overlap: int) -> str:
+    """
+    Join two consecutive chunks, keeping their shared overlap once
+    
+    Args:
+        first: The earlier chunk
+        second: The chunk that follows it
+        max_overlap: Longest overlap to look for, in characters
+    
+    Returns:
+        The merged text
+    """
+    for size in range(min(len(first), len(second), max_overlap), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + "\n" + second
+
+def join_consecutive_chunks(chunks: List[Dict[str, Any]], max_overlap: int) -> List[Dict[str, Any]]:
+    """
+    Merge runs of chunks that follow each other in the same policy document
+    
+    Only neighbours in the given order are merged, and the order is kept.
+    Chunks need "policy_hash" and "chunk_index"; others are passed through.
+    A merged chunk keeps the ID, index and name of its first part, the
+    highest score of its parts, and the original chunks under "parts".
+    
+    Args:
+        chunks: Chunks in the order they are presented
+        max_overlap: Longest overlap between consecutive chunks, in characters
+    
+    Returns:
+        The merged chunks, in the given order
+    """
+    merged: List[Dict[str, Any]] = []
+    
+    for chunk in chunks:
+        previous = merged[-1] if merged else None
+        if (
+            previous is not None
+            and chunk.get("policy_hash") is not None
+            and chunk.get("policy_hash") == previous.get("policy_hash")
+            and chunk.get("chunk_index") == previous["parts"][-1].get("chunk_index", -2) + 1
+        ):
+            previous["text"] = merge_overlapping_text(previous["text"], chunk["text"], max_overlap)
+            previous["score"] = max(previous.get("score", 0.0), chunk.get("score", 0.0))
+            previous["parts"].append(chunk)
+        else:
+            merged.append({**chunk, "parts": [chunk]})
+    
+    return merged
+
+def merge_adjacent_chunks(chunks: List[Dict[str, Any]], max_overlap: int) -> List[Dict[str, Any]]:
+    """
+    Merge chunks that are consecutive in the same policy document
+    
+    See join_consecutive_chunks for the merged chunks.
+    
+    Args:
+        chunks: Retrieved chunks
+        max_overlap: Longest overlap between consecutive chunks, in characters
+    
+    Returns:
+        The merged chunks, highest score first
+    """
+    ordered = sorted(
+        chunks,
+        key=lambda chunk: (chunk.get("policy_hash") is None, chunk.get("policy_hash") or "", chunk.get("chunk_index", 0))
+    )
+    merged = join_consecutive_chunks(ordered, max_overlap)
+    return sorted(merged, key=lambda chunk: chunk.get("score", 0.0), reverse=True)
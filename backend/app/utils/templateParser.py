@@ -1,36 +1,122 @@
 import re
-from typing import List
+from datetime import datetime
+from typing import List, Dict, Tuple, Union
 from app.db.models import InputField
 
-def parse_template(template_content: str) -> List[InputField]:
+# Regular expression to match input fields in the template
+INPUT_FIELD_PATTERN = re.compile(
+    r"#############\s*title:\s*([^\n]+)\s*description:\s*([^#]+)\s*#############",
+    re.DOTALL
+)
+
+class FieldSlot:
+    """A field in a compiled template and the original text of its block"""
+    
+    __slots__ = ("field_id", "text")
+    
+    def __init__(self, field_id: str, text: str):
+        self.field_id = field_id
+        self.text = text
+
+class CompiledTemplate:
     """
-    Parse a template string and extract input fields
+    A template split into literal text and field slots
+    
+    Filling a compiled template is a single pass over its segments.
+    """
+    
+    def __init__(self, segments: List[Union[str, FieldSlot]], input_fields: List[InputField]):
+        self.segments = segments
+        self.input_fields = input_fields
+    
+    def fill(self, input_values: dict) -> str:
+        """
+        Fill the template with user input values
+        
+        Args:
+            input_values: Dict with field IDs as keys and user inputs as values
+        
+        Returns:
+            The filled template; fields without a value keep their original block
+        """
+        return "".join([
+            segment if isinstance(segment, str) else input_values.get(segment.field_id, segment.text)
+            for segment in self.segments
+        ])
+
+def compile_template(template_content: str) -> CompiledTemplate:
+    """
+    Compile a template string into literal segments and field slots
     
     Args:
         template_content: The template content string
-        
+    
     Returns:
-        List of InputField objects
+        The compiled template
     """
-    # Regular expression to match input fields in the template
-    input_field_pattern = r"#############\s*title:\s*([^\n]+)\s*description:\s*([^#]+)\s*#############"
-    matches = re.finditer(input_field_pattern, template_content, re.DOTALL)
-    
+    segments: List[Union[str, FieldSlot]] = []
     input_fields = []
-    for i, match in enumerate(matches):
+    position = 0
+    
+    for i, match in enumerate(INPUT_FIELD_PATTERN.finditer(template_content)):
         field_id = f"field-{i+1}"
-        title = match.group(1).strip()
-        description = match.group(2).strip()
         
-        input_field = InputField(
-            id=field_id,
-            title=title,
-            description=description
-        )
+        if match.start() > position:
+            segments.append(template_content[position:match.start()])
+        segments.append(FieldSlot(field_id, match.group(0)))
+        position = match.end()
         
-        input_fields.append(input_field)
+        input_fields.append(InputField(
+            id=field_id,
+            title=match.group(1).strip(),
+            description=match.group(2).strip()
+        ))
+    
+    if position < len(template_content):
+        segments.append(template_content[position:])
+    
+    return CompiledTemplate(segments, input_fields)
+
+# Compiled templates keyed by template ID, with the updated_at they were compiled for
+_compiled_templates: Dict[str, Tuple[datetime, CompiledTemplate]] = {}
+
+def cache_compiled_template(template_id: str, updated_at: datetime, compiled: CompiledTemplate):
+    """Cache the compiled form of a template version"""
+    _compiled_templates[template_id] = (updated_at, compiled)
+
+def invalidate_compiled_template(template_id: str):
+    """Drop the cached compiled form of a template"""
+    _compiled_templates.pop(template_id, None)
+
+def get_compiled_template(template) -> CompiledTemplate:
+    """
+    Get the compiled form of a template, compiling it if it is not cached
+    
+    Args:
+        template: The Template model
+    
+    Returns:
+        The compiled template
+    """
+    cached = _compiled_templates.get(template.id)
+    if cached is not None and cached[0] == template.updated_at:
+        return cached[1]
     
-    return input_fields
+    compiled = compile_template(template.content)
+    cache_compiled_template(template.id, template.updated_at, compiled)
+    return compiled
+
+def parse_template(template_content: str) -> List[InputField]:
+    """
+    Parse a template string and extract input fields
+    
+    Args:
+        template_content: The template content string
+    
+    Returns:
+        List of InputField objects
+    """
+    return compile_template(template_content).input_fields
 
 def fill_template(template_content: str, input_values: dict) -> str:
     """
@@ -39,28 +125,8 @@ def fill_template(template_content: str, input_values: dict) -> str:
     Args:
         template_content: The template content
         input_values: Dict with field IDs as keys and user inputs as values
-        
+    
     Returns:
         The filled template with user inputs
     """
-    # Get input fields and their positions
-    input_fields = parse_template(template_content)
-    filled_template = template_content
-    
-    # Replace each input field block with the user's value
-    for field in input_fields:
-        if field.id in input_values:
-            user_value = input_values[field.id]
-            
-            # Create pattern to match this specific field
-            field_pattern = re.compile(
-                r"#############\s*title:\s*" + re.escape(field.title) + 
-                r"\s*description:\s*" + re.escape(field.description) + 
-                r"\s*#############",
-                re.DOTALL
-            )
-            
-            # Replace the field with user input
-            filled_template = field_pattern.sub(user_value, filled_template)
-    
-    return filled_template 
\ No newline at end of file
+    return compile_template(template_content).fill(input_values)
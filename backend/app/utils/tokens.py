@@ -0,0 +1,95 @@
+from functools import lru_cache
+from typing import Optional
+import tiktoken
+
+# Rough characters-per-token ratio used when no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+# Context window sizes by model name prefix; the longest matching prefix wins
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+}
+
+# Context window assumed for unknown models
+DEFAULT_CONTEXT_WINDOW = 8192
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """
+    Get the tiktoken encoding for a model
+    
+    Unknown models (e.g. on-prem model names) use cl100k_base. If the encoding
+    files cannot be loaded, for example on an air-gapped host, None is returned
+    and token counts fall back to an estimate.
+    
+    Args:
+        model: The model name
+    
+    Returns:
+        The encoding, or None if it could not be loaded
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"Error loading tokenizer for {model}, estimating token counts: {e}")
+        return None
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Count the number of tokens in a text for a model
+    
+    Args:
+        text: The text to count
+        model: The model name
+    
+    Returns:
+        Number of tokens
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text: str, max_tokens: int, model: str) -> str:
+    """
+    Cut a text down to at most a number of tokens
+    
+    Args:
+        text: The text to truncate
+        max_tokens: Maximum number of tokens to keep
+        model: The model name
+    
+    Returns:
+        The text, truncated if it was longer than max_tokens
+    """
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+def get_context_window(model: str) -> int:
+    """
+    Get the context window size of a model
+    
+    Args:
+        model: The model name
+    
+    Returns:
+        Maximum number of prompt and completion tokens
+    """
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model.startswith(prefix)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
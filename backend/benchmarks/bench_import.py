@@ -0,0 +1,95 @@
+"""
+Benchmark the cold import of the API and check that it has no side effects
+
+Imports app.main in fresh interpreters with -X importtime and reports the
+wall time and the packages that take longest to import. The run fails if
+an ingestion-only dependency is imported, if the import creates the upload
+directory, or if the median import time exceeds --max-ms, so it can guard
+against startup regressions in CI.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_import [--runs 5] [--max-ms 0]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import tempfile
+from collections import defaultdict
+
+# Only needed for ingestion, so they must be imported lazily
+LAZY_MODULES = ["langchain", "pdf2image", "pytesseract"]
+
+IMPORT_SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "ms": elapsed * 1000,
+    "lazy_loaded": [name for name in %r if name in sys.modules],
+}))
+""" % (LAZY_MODULES,)
+
+def import_once(upload_dir: str) -> tuple:
+    """Import app.main in a fresh interpreter, returning its report and import times"""
+    env = dict(os.environ, UPLOAD_DIR=upload_dir, STORAGE_BACKEND="memory")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True
+    )
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    package_us = defaultdict(int)
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        package_us[name.strip().split(".")[0]] += int(self_us)
+    return report, package_us
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="Number of cold imports")
+    parser.add_argument("--max-ms", type=float, default=0, help="Fail above this median import time (0 for no limit)")
+    parser.add_argument("--top", type=int, default=10, help="Number of packages to list")
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        upload_dir = os.path.join(temp_dir, "uploads")
+        runs = [import_once(upload_dir) for _ in range(args.runs)]
+        created_upload_dir = os.path.exists(upload_dir)
+    
+    times = [report["ms"] for report, _ in runs]
+    median_ms = statistics.median(times)
+    print(f"import app.main: median {median_ms:.0f} ms, min {min(times):.0f} ms over {len(times)} runs")
+    
+    package_ms = defaultdict(float)
+    for _, package_us in runs:
+        for name, us in package_us.items():
+            package_ms[name] += us / 1000 / len(runs)
+    print(f"\n{'package':<24} {'self (ms)':>10}")
+    for name, ms in sorted(package_ms.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{name:<24} {ms:>10.1f}")
+    
+    failures = []
+    lazy_loaded = sorted({name for report, _ in runs for name in report["lazy_loaded"]})
+    if lazy_loaded:
+        failures.append(f"ingestion-only modules imported eagerly: {', '.join(lazy_loaded)}")
+    if created_upload_dir:
+        failures.append("importing app.main created the upload directory")
+    if args.max_ms and median_ms > args.max_ms:
+        failures.append(f"median import time {median_ms:.0f} ms exceeds {args.max_ms:.0f} ms")
+    
+    for failure in failures:
+        print(f"\nFAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Microbenchmarks of the backend's CPU-bound hot paths
+
+Runs offline: nothing here calls the AI API or a vector database. Each
+case is timed with timeit, calibrated to take at least 0.2 seconds per
+repeat, and the best and median times per call are reported.
+
+Results can be written as JSON and compared with an earlier run, which
+adds the speedup over that run (above 1x is faster), e.g. before and
+after a change:
+
+    python -m benchmarks.bench_suite --json before.json
+    (make the change)
+    python -m benchmarks.bench_suite --json after.json --compare before.json
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_suite [--filter NAME] [--repeat 5] [--json PATH] [--compare PATH]
+"""
+import sys
+import json
+import random
+import asyncio
+import timeit
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime
+from typing import Callable, Dict, Any, List, Iterator, Tuple
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from app.db.models import Template, GenerateResponse, RefinementTurn
+from app.utils.templateParser import parse_template, compile_template, fill_template
+from app.utils.pdf import split_text
+from app.core.ai import construct_generation_prompt, construct_refinement_messages
+from app.core.database import build_points
+
+WORDS = "policy employee leave request manager approval days notice period section applies company".split()
+
+def words(rng: random.Random, count: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+def make_template(fields: int, filler_words: int, rng: random.Random) -> str:
+    """Build a template with the given number of fields and filler text between them"""
+    parts = []
+    for i in range(fields):
+        parts.append(words(rng, filler_words))
+        parts.append(f"\n#############\ntitle: field {i}\ndescription: value for field {i}\n#############\n")
+    parts.append(words(rng, filler_words))
+    return "".join(parts)
+
+def make_document(chars: int, rng: random.Random) -> str:
+    """Build document text with paragraphs of varying length"""
+    paragraphs = []
+    size = 0
+    while size < chars:
+        paragraph = ". ".join(words(rng, rng.randint(8, 20)) for _ in range(rng.randint(2, 8))) + "."
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+    return "\n\n".join(paragraphs)[:chars]
+
+def make_chunks(count: int, rng: random.Random) -> List[Dict[str, Any]]:
+    """Build retrieved policy chunks, highest score first"""
+    return [
+        {
+            "id": f"chunk-{i}",
+            "text": make_document(1000, rng),
+            "policy_name": f"Policy {i % 5}.pdf",
+            "policy_hash": f"hash-{i % 5}",
+            "chunk_index": i,
+            "score": 1.0 - i / count,
+        }
+        for i in range(count)
+    ]
+
+def make_templates(count: int, rng: random.Random) -> List[Template]:
+    now = datetime(2024, 1, 1)
+    templates = []
+    for i in range(count):
+        content = make_template(10, 20, rng)
+        templates.append(Template(
+            id=f"template-{i}",
+            name=f"Template {i}",
+            description=words(rng, 12),
+            content=content,
+            associated_policies=[f"policy-{j}" for j in range(3)],
+            created_at=now,
+            updated_at=now,
+            input_fields=parse_template(content)
+        ))
+    return templates
+
+def make_responses(count: int, rng: random.Random) -> List[GenerateResponse]:
+    now = datetime(2024, 1, 1)
+    return [
+        GenerateResponse(id=f"doc-{i}", content=make_document(3000, rng), generated_at=now, template_id="template-1")
+        for i in range(count)
+    ]
+
+def cases(loop: asyncio.AbstractEventLoop) -> Iterator[Tuple[str, Dict[str, Any], Callable[[], Any]]]:
+    """Yield (name, parameters, function to time) for every benchmark case"""
+    rng = random.Random(0)
+    
+    for fields, filler_words in [(5, 50), (20, 100), (100, 100), (500, 50)]:
+        content = make_template(fields, filler_words, rng)
+        inputs = {f"field-{i + 1}": f"answer {i}" for i in range(fields)}
+        compiled = compile_template(content)
+        params = {"fields": fields, "chars": len(content)}
+        yield "parse_template", params, lambda content=content: parse_template(content)
+        yield "compile_template", params, lambda content=content: compile_template(content)
+        yield "fill_template", params, lambda content=content, inputs=inputs: fill_template(content, inputs)
+        yield "compiled_fill", params, lambda compiled=compiled, inputs=inputs: compiled.fill(inputs)
+    
+    for chars in [100_000, 1_000_000]:
+        document = make_document(chars, rng)
+        yield "split_text", {"chars": chars}, lambda document=document: loop.run_until_complete(split_text(document))
+    
+    for count in [10, 50, 200]:
+        chunks = make_chunks(count, rng)
+        filled = make_template(20, 30, rng)
+        yield "construct_generation_prompt", {"chunks": count}, (
+            lambda chunks=chunks, filled=filled: loop.run_until_complete(construct_generation_prompt(filled, chunks))
+        )
+        
+        context = {
+            "filled_template": filled,
+            "policy_sections": "\n\n".join(f"From {chunk['policy_name']}:\n{chunk['text']}" for chunk in chunks),
+        }
+        turns = [
+            RefinementTurn(feedback=words(rng, 15), content=make_document(2000, rng), refined_at=datetime(2024, 1, 1))
+            for _ in range(4)
+        ]
+        original = make_document(3000, rng)
+        yield "construct_refinement_messages", {"chunks": count, "turns": len(turns)}, (
+            lambda context=context, turns=turns, original=original: loop.run_until_complete(
+                construct_refinement_messages(original, turns, "Make it shorter", context)
+            )
+        )
+    
+    template_adapter = TypeAdapter(List[Template])
+    response_adapter = TypeAdapter(List[GenerateResponse])
+    for count in [10, 100, 1000]:
+        templates = make_templates(count, rng)
+        responses = make_responses(count, rng)
+        yield "serialize_templates_json", {"items": count}, lambda templates=templates: template_adapter.dump_json(templates)
+        yield "serialize_templates_encoder", {"items": count}, lambda templates=templates: jsonable_encoder({"templates": templates})
+        yield "serialize_responses_json", {"items": count}, lambda responses=responses: response_adapter.dump_json(responses)
+    
+    for count in [100, 1000]:
+        chunks = [make_document(1000, rng) for _ in range(count)]
+        embeddings = [[rng.random() for _ in range(1536)] for _ in range(count)]
+        yield "build_points", {"chunks": count}, (
+            lambda chunks=chunks, embeddings=embeddings: build_points("hash", "policy-1", "Policy.pdf", "/uploads/policy.pdf", chunks, embeddings)
+        )
+
+def measure(function: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    """Time a function, returning per-call times in milliseconds"""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    times = [total / number * 1000 for total in timer.repeat(repeat=repeat, number=number)]
+    return {"number": number, "repeat": repeat, "best_ms": min(times), "median_ms": statistics.median(times)}
+
+def case_key(result: Dict[str, Any]) -> str:
+    return result["name"] + " " + " ".join(f"{key}={value}" for key, value in result["params"].items())
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--filter", default="", help="Only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed repeats per case")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Compare with the results in this file")
+    args = parser.parse_args()
+    
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {case_key(result): result for result in json.load(f)["results"]}
+    
+    loop = asyncio.new_event_loop()
+    results = []
+    print(f"{'case':<58} {'best (ms)':>11} {'median (ms)':>12} {'vs baseline':>12}")
+    for name, params, function in cases(loop):
+        if args.filter not in name:
+            continue
+        result = {"name": name, "params": params, **measure(function, args.repeat)}
+        results.append(result)
+        
+        base = baseline.get(case_key(result))
+        change = f"{base['best_ms'] / result['best_ms']:>11.2f}x" if base else f"{'':>12}"
+        print(f"{case_key(result):<58} {result['best_ms']:>11.4f} {result['median_ms']:>12.4f} {change}")
+    loop.close()
+    
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "results": results,
+            }, f, indent=2)
+        print(f"\nWrote {len(results)} results to {args.json}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark policy chunk search on the local vector index and on Qdrant
+
+Stores random 1536-dimensional embeddings for a corpus of policies, then
+times similarity_search with and without a policy filter on both backends.
+The Qdrant timings use the server at QDRANT_HOST if it is reachable, and
+otherwise qdrant-client's in-process local mode, which is not representative
+of a server (it has no network hop but also no HNSW index).
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_vector_search
+"""
+import time
+import asyncio
+import tempfile
+import numpy as np
+from qdrant_client import AsyncQdrantClient
+from app.core import database
+from app.core.config import settings
+
+DIM = 1536
+CHUNKS_PER_POLICY = 200
+QUERIES = 50
+
+async def time_search(queries, policy_hashes) -> float:
+    """Get the mean similarity_search latency in milliseconds"""
+    start = time.perf_counter()
+    for query in queries:
+        await database.similarity_search(query, policy_hashes)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+async def fill(policies: int, rng) -> list:
+    """Store a corpus in the configured backend and return the policy hashes"""
+    hashes = []
+    for p in range(policies):
+        content_hash = f"policy-{p}"
+        vectors = rng.standard_normal((CHUNKS_PER_POLICY, DIM), dtype=np.float32)
+        chunks = [f"policy {p} chunk {i}" for i in range(CHUNKS_PER_POLICY)]
+        await database.store_embeddings(content_hash, content_hash, content_hash, "", chunks, vectors.tolist())
+        hashes.append(content_hash)
+    return hashes
+
+async def connect_qdrant() -> str:
+    """Point the database module at a Qdrant server, or at local mode if none is reachable"""
+    settings.vector_db.backend = "qdrant"
+    settings.vector_db.collection_name = "bench_vector_search"
+    try:
+        await database.get_qdrant_client().get_collections()
+        return "server"
+    except Exception:
+        database._client = AsyncQdrantClient(location=":memory:")
+        return "local mode"
+
+async def reset_qdrant():
+    """Switch to Qdrant with an empty benchmark collection"""
+    settings.vector_db.backend = "qdrant"
+    await database.get_qdrant_client().delete_collection(settings.vector_db.collection_name)
+    await database.init_collection()
+
+async def main():
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((QUERIES, DIM), dtype=np.float32).tolist()
+    qdrant_target = await connect_qdrant()
+    
+    print(f"{'chunks':>8} {'filter':>8} {'local (ms)':>11} {f'qdrant {qdrant_target} (ms)':>24} {'speedup':>8}")
+    for policies in [5, 25, 50]:
+        with tempfile.TemporaryDirectory() as local_path:
+            settings.vector_db.backend = "local"
+            settings.vector_db.local_path = local_path
+            database._local_index = None
+            hashes = await fill(policies, rng)
+            local = {
+                "all": await time_search(queries, None),
+                "3 docs": await time_search(queries, hashes[:3]),
+            }
+        
+        await reset_qdrant()
+        await fill(policies, rng)
+        for name, policy_hashes in [("all", None), ("3 docs", hashes[:3])]:
+            qdrant_ms = await time_search(queries, policy_hashes)
+            print(
+                f"{policies * CHUNKS_PER_POLICY:>8} {name:>8} {local[name]:>11.3f} "
+                f"{qdrant_ms:>24.3f} {qdrant_ms / local[name]:>7.1f}x"
+            )
+    
+    await database.get_qdrant_client().delete_collection(settings.vector_db.collection_name)
+    await database.close_qdrant_client()
+
+if __name__ == "__main__":
+    asyncio.run(main())
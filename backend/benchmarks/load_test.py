@@ -0,0 +1,341 @@
+"""
+End-to-end load test of the API against local stand-ins
+
+Starts the OpenAI stub (benchmarks.openai_stub) and the API under uvicorn,
+with Qdrant replaced by the in-process local vector index or by Qdrant's
+in-memory mode and all state in a temporary directory, so nothing leaves
+the machine. It then runs these phases at the given concurrency and
+reports throughput and latency percentiles for each:
+
+- policies: uploads PDF policies, timing the upload request and the time
+  until the ingestion job finishes (ingestion needs poppler and Tesseract)
+- generate: POST /api/v1/generate against a template of those policies
+- refine: POST /api/v1/refine/{id} on the generated documents
+
+Pass --app-url to load-test an API that is already running instead; it is
+then up to that deployment which AI API and vector database it uses.
+
+Usage (from the backend directory):
+    python -m benchmarks.load_test [--requests 200] [--concurrency 16] [--stream]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import httpx
+from app.core.ai import GENERATION_ERROR_MESSAGE
+
+TEMPLATE = """Leave request for #############
+title: Employee name
+description: The name of the employee
+#############
+
+Dates requested: #############
+title: Dates
+description: The days of leave requested
+#############
+"""
+
+POLICY_PARAGRAPH = (
+    "Employees must submit leave requests at least {days} days in advance. "
+    "Requests are approved by the employee's manager. Policy section {section}."
+)
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def make_pdf(lines: List[str]) -> bytes:
+    """Build a single-page PDF with a text layer of the given lines"""
+    def escape(text: str) -> str:
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    
+    text = "BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(f"({escape(line)}) '" for line in lines) + " ET"
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(text), text.encode("latin-1")),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(pdf)
+
+def summarize(name: str, latencies: List[float], errors: int, seconds: float) -> Dict[str, Any]:
+    """Get the throughput and latency percentiles of a phase, in requests/s and ms"""
+    result = {"phase": name, "requests": len(latencies) + errors, "errors": errors, "seconds": seconds}
+    result["throughput"] = result["requests"] / seconds if seconds else 0.0
+    if len(latencies) >= 2:
+        cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+        result.update(p50_ms=cuts[49] * 1000, p95_ms=cuts[94] * 1000, p99_ms=cuts[98] * 1000)
+    elif latencies:
+        result.update(p50_ms=latencies[0] * 1000, p95_ms=latencies[0] * 1000, p99_ms=latencies[0] * 1000)
+    return result
+
+async def run_phase(
+    name: str,
+    count: int,
+    concurrency: int,
+    request: Callable[[int], Awaitable[bool]]
+) -> Dict[str, Any]:
+    """
+    Send count requests with at most concurrency in flight
+    
+    Args:
+        name: Phase name for the report
+        count: Number of requests
+        concurrency: Requests in flight at once
+        request: Sends request i and returns whether it succeeded
+    
+    Returns:
+        The phase summary
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+    
+    async def timed_request(i: int):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                ok = await request(i)
+            except httpx.HTTPError as e:
+                print(f"Error in {name} request {i}: {e!r}", file=sys.stderr)
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+    
+    start = time.perf_counter()
+    await asyncio.gather(*[timed_request(i) for i in range(count)])
+    return summarize(name, latencies, errors, time.perf_counter() - start)
+
+async def read_stream(response: httpx.Response) -> Optional[Dict[str, Any]]:
+    """Read server-sent events until "done", returning its data, or None on "error\""""
+    event = None
+    async for line in response.aiter_lines():
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:") and event in ("done", "error"):
+            return json.loads(line[len("data:"):]) if event == "done" else None
+    return None
+
+def json_body(response: httpx.Response) -> Any:
+    """Decode a successful response, raising for an error status"""
+    response.raise_for_status()
+    return response.json()
+
+async def wait_for_job(client: httpx.AsyncClient, job_id: str) -> Dict[str, Any]:
+    """Poll an ingestion job until it finishes"""
+    while True:
+        job = json_body(await client.get(f"/api/v1/policies/jobs/{job_id}"))
+        if job["status"] in ("completed", "failed", "cancelled"):
+            return job
+        await asyncio.sleep(0.1)
+
+async def run_load(args, base_url: str) -> List[Dict[str, Any]]:
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    results = []
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        # Policies: upload distinct documents and wait for their ingestion
+        policy_ids = []
+        ingest_latencies: List[float] = []
+        ingest_errors = 0
+        
+        async def upload(i: int) -> bool:
+            nonlocal ingest_errors
+            lines = [POLICY_PARAGRAPH.format(days=i + 2, section=f"{i}.{j}") for j in range(40)]
+            start = time.perf_counter()
+            response = await client.post(
+                "/api/v1/policies",
+                files={"file": (f"policy-{i}.pdf", make_pdf(lines), "application/pdf")},
+                data={"description": f"Load test policy {i}"}
+            )
+            if response.status_code != 202:
+                return False
+            job = await wait_for_job(client, response.json()["id"])
+            if job["status"] == "completed":
+                ingest_latencies.append(time.perf_counter() - start)
+                policy_ids.append(job["policy_id"])
+            else:
+                ingest_errors += 1
+                print(f"Ingestion of policy {i} {job['status']}: {job.get('error')}", file=sys.stderr)
+            return True
+        
+        if args.policies:
+            start = time.perf_counter()
+            results.append(await run_phase("policies (upload)", args.policies, args.concurrency, upload))
+            results.append(summarize("policies (ingest)", ingest_latencies, ingest_errors, time.perf_counter() - start))
+        
+        template = json_body(await client.post("/api/v1/templates", json={
+            "name": "Load test",
+            "description": "Leave request",
+            "content": TEMPLATE,
+            "associated_policies": policy_ids,
+        }))
+        field_ids = [field["id"] for field in template["input_fields"]]
+        
+        # Generate: the input pool size controls the share of repeated requests
+        document_ids: List[str] = []
+        distinct_inputs = args.distinct_inputs or args.requests
+        
+        async def generate(i: int) -> bool:
+            n = i % distinct_inputs
+            payload = {
+                "template_id": template["id"],
+                "inputs": {field_ids[0]: f"Employee {n}", field_ids[1]: f"{n % 28 + 1} March"},
+            }
+            if args.stream:
+                async with client.stream("POST", "/api/v1/generate/stream", json=payload) as response:
+                    if response.status_code != 200:
+                        return False
+                    document = await read_stream(response)
+                if document is None:
+                    return False
+            else:
+                response = await client.post("/api/v1/generate", json=payload)
+                if response.status_code != 200:
+                    return False
+                document = response.json()
+                if document["content"] == GENERATION_ERROR_MESSAGE:
+                    return False
+            document_ids.append(document["id"])
+            return True
+        
+        if "generate" in args.phases:
+            results.append(await run_phase("generate", args.requests, args.concurrency, generate))
+        
+        async def refine(i: int) -> bool:
+            path = f"/api/v1/refine/{document_ids[i % len(document_ids)]}"
+            payload = {"feedback": f"Make it more formal ({i})"}
+            if args.stream:
+                async with client.stream("POST", path + "/stream", json=payload) as response:
+                    return response.status_code == 200 and await read_stream(response) is not None
+            response = await client.post(path, json=payload)
+            return response.status_code == 200 and response.json()["content"] != GENERATION_ERROR_MESSAGE
+        
+        if "refine" in args.phases:
+            if document_ids:
+                results.append(await run_phase("refine", args.requests, args.concurrency, refine))
+            else:
+                print("Skipping refine: no documents were generated", file=sys.stderr)
+    return results
+
+def start_process(command: List[str], env: Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 60):
+    """Poll a URL until it returns 200, failing if the process exits"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with status {process.returncode} before {url} was ready")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} was not ready after {timeout:.0f}s")
+
+def print_report(results: List[Dict[str, Any]]):
+    print(f"{'phase':<20} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    for result in results:
+        percentiles = " ".join(
+            f"{result[key]:>9.1f}" if key in result else f"{'-':>9}"
+            for key in ("p50_ms", "p95_ms", "p99_ms")
+        )
+        print(f"{result['phase']:<20} {result['requests']:>9} {result['errors']:>7} {result['throughput']:>8.1f} {percentiles}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="Requests per generate and refine phase")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--phases", default="policies,generate,refine", help="Comma-separated phases to run")
+    parser.add_argument("--policies", type=int, default=5, help="Policies to upload in the policies phase")
+    parser.add_argument("--distinct-inputs", type=int, default=0, help="Distinct generate inputs, to exercise caching (0 for all distinct)")
+    parser.add_argument("--stream", action="store_true", help="Use the streaming generate and refine endpoints")
+    parser.add_argument("--timeout", type=float, default=300, help="Per-request timeout in seconds")
+    parser.add_argument("--app-url", help="Load-test an API that is already running")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers of the API (local vector backend only)")
+    parser.add_argument("--vector-backend", choices=["local", "qdrant-memory"], default="local")
+    parser.add_argument("--stub-latency-ms", type=float, default=200)
+    parser.add_argument("--stub-token-latency-ms", type=float, default=5)
+    parser.add_argument("--stub-completion-tokens", type=int, default=200)
+    parser.add_argument("--stub-failure-rate", type=float, default=0.0)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+    args.phases = args.phases.split(",")
+    if "policies" not in args.phases:
+        args.policies = 0
+    if args.workers > 1 and args.vector_backend == "qdrant-memory":
+        parser.error("Qdrant's in-memory mode cannot be shared by several workers")
+    
+    processes = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            base_url = args.app_url
+            if base_url is None:
+                stub_port, app_port = free_port(), free_port()
+                processes.append(start_process([
+                    sys.executable, "-m", "benchmarks.openai_stub",
+                    "--port", str(stub_port),
+                    "--latency-ms", str(args.stub_latency_ms),
+                    "--token-latency-ms", str(args.stub_token_latency_ms),
+                    "--completion-tokens", str(args.stub_completion_tokens),
+                    "--failure-rate", str(args.stub_failure_rate),
+                ], dict(os.environ)))
+                
+                env = dict(
+                    os.environ,
+                    OPENAI_API_BASE=f"http://127.0.0.1:{stub_port}/v1",
+                    OPENAI_API_KEY="stub",
+                    UPLOAD_DIR=os.path.join(temp_dir, "uploads"),
+                    STORAGE_BACKEND="sqlite",
+                )
+                if args.vector_backend == "local":
+                    env["VECTOR_BACKEND"] = "local"
+                else:
+                    env.update(VECTOR_BACKEND="qdrant", QDRANT_LOCATION=":memory:")
+                processes.append(start_process([
+                    sys.executable, "-m", "uvicorn", "app.main:app",
+                    "--port", str(app_port),
+                    "--workers", str(args.workers),
+                    "--log-level", "warning",
+                ], env))
+                
+                base_url = f"http://127.0.0.1:{app_port}"
+                wait_until_ready(f"{base_url}/api/ready", processes[-1])
+            
+            results = asyncio.run(run_load(args, base_url))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+    
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Local stand-in for an OpenAI-compatible API, for load tests
+
+Serves /v1/embeddings with deterministic vectors derived from each input,
+so identical texts get identical embeddings, and /v1/chat/completions with
+filler text, in both normal and streaming mode. Latency and failures are
+injected to mimic a shared model server:
+
+- every request waits --latency-ms (with --jitter relative spread) before
+  responding or sending its first token
+- completions then take --token-latency-ms per generated token
+- a --failure-rate fraction of requests fail with --failure-status
+
+Usage (from the backend directory):
+    python -m benchmarks.openai_stub [--port 8001] [--latency-ms 200] [--token-latency-ms 5]
+"""
+import json
+import random
+import asyncio
+import hashlib
+import argparse
+from typing import Optional
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EMBEDDING_DIM = 1536
+WORDS = "the policy requires employees to submit requests in advance with manager approval".split()
+
+def create_app(
+    latency_ms: float = 200,
+    jitter: float = 0.2,
+    token_latency_ms: float = 5,
+    completion_tokens: int = 200,
+    failure_rate: float = 0.0,
+    failure_status: int = 500,
+    seed: int = 0
+) -> FastAPI:
+    """
+    Build the stub API
+    
+    Args:
+        latency_ms: Delay before each response or first streamed token
+        jitter: Relative random spread of latency_ms
+        token_latency_ms: Delay per generated token
+        completion_tokens: Tokens (words) per completion, unless max_tokens is lower
+        failure_rate: Fraction of requests that fail
+        failure_status: HTTP status of failed requests
+        seed: Seed of the latency and failure draws
+    
+    Returns:
+        The FastAPI app
+    """
+    app = FastAPI(title="OpenAI API stub")
+    rng = random.Random(seed)
+    
+    async def wait():
+        await asyncio.sleep(max(0.0, latency_ms * (1 + rng.uniform(-jitter, jitter))) / 1000)
+    
+    def failure() -> Optional[JSONResponse]:
+        if failure_rate and rng.random() < failure_rate:
+            return JSONResponse(status_code=failure_status, content={"error": {"message": "Injected failure"}})
+        return None
+    
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await wait()
+        failed = failure()
+        if failed:
+            return failed
+        
+        data = []
+        for index, text in enumerate(inputs):
+            text_seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+            vector = np.random.default_rng(text_seed).standard_normal(EMBEDDING_DIM, dtype=np.float32)
+            data.append({"object": "embedding", "index": index, "embedding": vector.tolist()})
+        tokens = sum(len(text) // 4 + 1 for text in inputs)
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+    
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt_tokens = sum(len(message.get("content") or "") // 4 + 1 for message in body["messages"])
+        tokens = min(completion_tokens, body.get("max_tokens") or completion_tokens)
+        words = [WORDS[i % len(WORDS)] for i in range(tokens)]
+        await wait()
+        failed = failure()
+        if failed:
+            return failed
+        
+        if not body.get("stream"):
+            await asyncio.sleep(token_latency_ms * tokens / 1000)
+            return {
+                "object": "chat.completion",
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": tokens, "total_tokens": prompt_tokens + tokens},
+            }
+        
+        async def events():
+            for i, word in enumerate(words):
+                chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(token_latency_ms / 1000)
+            yield "data: [DONE]\n\n"
+        
+        return StreamingResponse(events(), media_type="text/event-stream")
+    
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=200, help="Delay before each response or first token")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Relative random spread of the latency")
+    parser.add_argument("--token-latency-ms", type=float, default=5, help="Delay per generated token")
+    parser.add_argument("--completion-tokens", type=int, default=200, help="Tokens per completion")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--failure-status", type=int, default=500, help="HTTP status of failed requests")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    
+    app = create_app(
+        latency_ms=args.latency_ms,
+        jitter=args.jitter,
+        token_latency_ms=args.token_latency_ms,
+        completion_tokens=args.completion_tokens,
+        failure_rate=args.failure_rate,
+        failure_status=args.failure_status,
+        seed=args.seed
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
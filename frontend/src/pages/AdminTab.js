@@ -38,9 +38,15 @@ import {
   deleteTemplate,
   getPolicies,
   uploadPolicy,
+  getPolicyJob,
   deletePolicy
 } from '../services/api';
 
+// Interval between ingestion job status checks
+const JOB_POLL_INTERVAL_MS = 2000;
+// Give up waiting for a policy to be processed after this long
+const JOB_MAX_WAIT_MS = 30 * 60 * 1000;
+
 function TabPanel(props) {
   const { children, value, index, ...other } = props;
 
@@ -286,7 +292,22 @@ const AdminTab = () => {
       setLoading(true);
       setError('');
       
-      await uploadPolicy(policyFile, policyDescription);
+      const response = await uploadPolicy(policyFile, policyDescription);
+      
+      // Wait for the document to be processed in the background
+      let job = response.data;
+      const deadline = Date.now() + JOB_MAX_WAIT_MS;
+      while (job.status === 'queued' || job.status === 'running') {
+        if (Date.now() >= deadline) {
+          throw new Error('Timed out waiting for the policy document to be processed');
+        }
+        await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+        job = (await getPolicyJob(job.id)).data;
+      }
+      
+      if (job.status !== 'completed') {
+        throw new Error(job.error || `Policy processing ${job.status}`);
+      }
       
       setSuccess('Policy document uploaded successfully!');
       setPolicyFile(null);
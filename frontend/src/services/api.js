@@ -47,6 +47,14 @@ export const uploadPolicy = (file, description = '') => {
   });
 };
 
+export const getPolicyJob = (jobId) => {
+  return api.get(`/policies/jobs/${jobId}`);
+};
+
+export const cancelPolicyJob = (jobId) => {
+  return api.delete(`/policies/jobs/${jobId}`);
+};
+
 export const deletePolicy = (id) => {
   return api.delete(`/policies/${id}`);
 };